@@ -0,0 +1,157 @@
+"""
+Compares yolo5's inference backends (backends.BACKENDS) for latency and accuracy on a local sample set.
+Needs the yolo5 runtime (torch, the yolov5 code and weights), so run it from the yolo5 image's working directory:
+
+    docker run --rm -v $PWD/bench:/usr/src/app/bench <yolo5-image> python bench/bench_backends.py \\
+        [--variants pytorch:640,torchscript:640,onnx:640,onnx-int8:640,onnx:416] [--images data/images] [--threads 4]
+
+Accuracy is measured against YOLO-format ground truth labels (`--labels`, one <image stem>.txt per image),
+or, without labels, against the detections of the `--reference` variant: precision, recall and F1 of the
+boxes matched by class at IoU >= `--iou`. Each variant runs in its own process, with its own threads and peak RSS.
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import common
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def run_case(app_dir, weights, backend, imgsz, threads, image_paths, repeats):
+    """
+    Loads one variant and predicts every image `repeats` times
+    :return: latency summary, load time, peak RSS and the detections of each image
+    """
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    from backends import backend_weights
+    from model_server import ModelServer
+
+    start = time.perf_counter()
+    server = ModelServer(weights=str(backend_weights(weights, backend, imgsz)), data='data/coco128.yaml',
+                         imgsz=imgsz, threads=threads)
+    load_s = time.perf_counter() - start
+
+    images = [server.decode(Path(path).read_bytes()) for path in image_paths]
+    detections = [server.predict(im0) for im0 in images]
+    latencies = []
+    for _ in range(repeats):
+        for im0 in images:
+            latencies += common.time_calls(server.predict, 1, setup=lambda: im0)
+
+    result = common.summarize(latencies)
+    result.update(load_s=load_s, peak_rss_mb=common.peak_rss_mb(), model_version=server.version)
+    return result, detections, server.names
+
+
+def iou(a, b):
+    ax1, ay1, ax2, ay2 = a['cx'] - a['width'] / 2, a['cy'] - a['height'] / 2, a['cx'] + a['width'] / 2, a['cy'] + a['height'] / 2
+    bx1, by1, bx2, by2 = b['cx'] - b['width'] / 2, b['cy'] - b['height'] / 2, b['cx'] + b['width'] / 2, b['cy'] + b['height'] / 2
+    inter = max(0.0, min(ax2, bx2) - max(ax1, bx1)) * max(0.0, min(ay2, by2) - max(ay1, by1))
+    union = a['width'] * a['height'] + b['width'] * b['height'] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def match(predicted, expected, iou_threshold):
+    """
+    Greedily matches the most confident predictions first, to expected boxes of the same class
+    :return: number of true positives
+    """
+    unmatched = list(expected)
+    true_positives = 0
+    for label in sorted(predicted, key=lambda label: -label.get('confidence', 1)):
+        candidates = [(iou(label, other), i) for i, other in enumerate(unmatched) if other['class'] == label['class']]
+        best = max(candidates, default=(0, None))
+        if best[0] >= iou_threshold:
+            unmatched.pop(best[1])
+            true_positives += 1
+    return true_positives
+
+
+def accuracy(detections, expected, iou_threshold):
+    """
+    :return: precision, recall and F1 of `detections` against `expected`, both lists of labels per image
+    """
+    true_positives = sum(match(predicted, truth, iou_threshold) for predicted, truth in zip(detections, expected))
+    predicted_count = sum(len(predicted) for predicted in detections)
+    expected_count = sum(len(truth) for truth in expected)
+    precision = true_positives / predicted_count if predicted_count else 0.0
+    recall = true_positives / expected_count if expected_count else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def read_labels(labels_dir, image_path, names):
+    """
+    :return: the YOLO-format ground truth of an image as label dicts, empty if it has no label file
+    """
+    path = Path(labels_dir) / f'{Path(image_path).stem}.txt'
+    if not path.exists():
+        return []
+    labels = []
+    for line in path.read_text().splitlines():
+        if line.strip():
+            class_id, cx, cy, width, height = line.split()[:5]
+            labels.append({'class': names[int(class_id)], 'cx': float(cx), 'cy': float(cy),
+                           'width': float(width), 'height': float(height)})
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', default='pytorch:640,torchscript:640,onnx:640,onnx-int8:640,onnx:416,onnx-int8:416')
+    parser.add_argument('--reference', default='pytorch:640', help='variant the others are compared to without --labels')
+    parser.add_argument('--weights', default='yolov5s.pt', help='PyTorch weights the other backends are exported from')
+    parser.add_argument('--images', default='data/images', help='directory of sample images')
+    parser.add_argument('--labels', help='directory of YOLO-format ground truth labels')
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--threads', type=int, default=0, help='CPU threads per forward pass (default: one per core)')
+    parser.add_argument('--repeats', type=int, default=5, help='passes over the sample set')
+    parser.add_argument('--app-dir', default=os.getcwd(), help="yolo5 app directory (default: current directory)")
+    common.add_report_args(parser)
+    args = parser.parse_args()
+
+    app_dir = str(Path(args.app_dir).resolve())
+    sys.path.insert(0, app_dir)
+    from backends import parse_variants, variant_name
+
+    image_paths = sorted(str(path) for path in Path(args.images).resolve().iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)
+    if not image_paths:
+        sys.exit(f'No images in {args.images}')
+
+    variants = parse_variants(args.variants)
+    reference = parse_variants(args.reference)[0]
+    if not args.labels and reference not in variants:
+        variants.insert(0, reference)
+
+    cases = {}
+    detections = {}
+    names = None
+    for backend, imgsz in variants:
+        name = variant_name(backend, imgsz)
+        result, detections[name], names = common.run_isolated(run_case, app_dir, args.weights, backend, imgsz, args.threads or None,
+                                                              image_paths, args.repeats)
+        cases[f'predict[{name},threads={args.threads or "default"}]'] = result
+        print(f"{name}: p50 {result['p50_ms']:.2f} ms, load {result['load_s']:.1f}s", file=sys.stderr)
+
+    if args.labels:
+        expected = [read_labels(args.labels, path, names) for path in image_paths]
+    else:
+        expected = detections[variant_name(*reference)]
+    for case, name in zip(cases.values(), detections):
+        case['accuracy'] = accuracy(detections[name], expected, args.iou)
+
+    results = {
+        'benchmark': 'backends',
+        'images': len(image_paths),
+        'accuracy_against': 'labels' if args.labels else variant_name(*reference),
+        'cases': cases,
+    }
+    sys.exit(common.report(results, args))
+
+
+if __name__ == '__main__':
+    main()
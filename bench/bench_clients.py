@@ -0,0 +1,94 @@
+"""
+Measures what the shared clients save per request, against local stand-ins:
+a keep-alive HTTP server playing yolo5, and moto playing S3.
+
+    python bench/bench_clients.py [--requests 200]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import boto3
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'polybot'))
+from clients import get_http_session, get_s3_client  # noqa: E402
+
+
+class FakeYolo(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, without this every keep-alive response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'status': 'success', 'result_path': {'labels': []}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def per_request_ms(func, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - start) / n * 1000
+
+
+def bench_http(n, payload):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeYolo)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/predict'
+    try:
+        return {
+            'new_connection_ms': per_request_ms(lambda: requests.post(url, data=payload), n),
+            'pooled_session_ms': per_request_ms(lambda: get_http_session().post(url, data=payload), n),
+        }
+    finally:
+        server.shutdown()
+
+
+def bench_s3(n, payload):
+    try:
+        from moto import mock_aws
+    except ImportError:
+        return {'skipped': 'moto is not installed'}
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    with mock_aws():
+        boto3.client('s3').create_bucket(Bucket='bench')
+        return {
+            'client_per_call_ms': per_request_ms(lambda: boto3.client('s3').put_object(Bucket='bench', Key='img', Body=payload), n),
+            'shared_client_ms': per_request_ms(lambda: get_s3_client().put_object(Bucket='bench', Key='img', Body=payload), n),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--payload-kb', type=int, default=100)
+    args = parser.parse_args()
+
+    payload = os.urandom(args.payload_kb * 1024)
+    print(json.dumps({
+        'requests': args.requests,
+        'payload_kb': args.payload_kb,
+        'http': bench_http(args.requests, payload),
+        's3': bench_s3(args.requests, payload),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
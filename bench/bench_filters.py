@@ -0,0 +1,80 @@
+"""
+Benchmarks every Img method over a matrix of image sizes (and blur levels for blur).
+
+    python bench/bench_filters.py [--sizes 640x480,1280x960] [--blur-levels 4,16] [--repeats 10]
+    python bench/bench_filters.py --output base.json
+    python bench/bench_filters.py --baseline base.json   # exits 1 on a p50 regression
+
+Each case runs in its own process, so its peak RSS isn't inflated by the previous cases.
+"""
+import argparse
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'polybot'))
+import common  # noqa: E402
+
+
+def make_jpeg(width, height, seed=0):
+    rgb = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(rgb).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def run_case(method, width, height, blur_level, repeats):
+    from img_proc import Img
+
+    jpeg = make_jpeg(width, height)
+    other = make_jpeg(width, height, seed=1)
+
+    def setup():
+        return Img('bench.jpg', buffer=jpeg)
+
+    calls = {
+        'decode': lambda _: setup(),
+        'blur': lambda img: img.blur(blur_level),
+        'contour': lambda img: img.contour(),
+        'rotate': lambda img: img.rotate(),
+        'salt_n_pepper': lambda img: img.salt_n_pepper(),
+        'segment': lambda img: img.segment(),
+        'concat': lambda img: img.concat(Img('other.jpg', buffer=other)),
+        'save_img': lambda img: img.encode(),
+    }
+    latencies = common.time_calls(calls[method], repeats, setup=None if method == 'decode' else setup)
+    result = common.summarize(latencies)
+    result['megapixels_per_s'] = result['throughput_per_s'] * width * height / 1e6
+    result['peak_rss_mb'] = common.peak_rss_mb()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='640x480,1280x960,2560x1920')
+    parser.add_argument('--blur-levels', default='4,16,32')
+    parser.add_argument('--methods', default='decode,blur,contour,rotate,salt_n_pepper,segment,concat,save_img')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--in-process', action='store_true', help='run all cases in this process (faster, RSS is cumulative)')
+    common.add_report_args(parser)
+    args = parser.parse_args()
+
+    cases = {}
+    for size in args.sizes.split(','):
+        width, height = (int(v) for v in size.split('x'))
+        for method in args.methods.split(','):
+            blur_levels = [int(v) for v in args.blur_levels.split(',')] if method == 'blur' else [None]
+            for blur_level in blur_levels:
+                name = f'{method}[{size}' + (f',blur={blur_level}]' if blur_level else ']')
+                case_args = (method, width, height, blur_level, args.repeats)
+                cases[name] = run_case(*case_args) if args.in_process else common.run_isolated(run_case, *case_args)
+                print(f"{name}: p50 {cases[name]['p50_ms']:.2f} ms", file=sys.stderr)
+
+    sys.exit(common.report({'benchmark': 'filters', 'repeats': args.repeats, 'cases': cases}, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Drives yolo5 /predict end to end through the Flask test client, with S3 stubbed by moto and Mongo by mongomock.
+Needs the yolo5 runtime (torch, the yolov5 code and weights), so run it from the yolo5 image's working directory:
+
+    docker run --rm -v $PWD/bench:/usr/src/app/bench <yolo5-image> python bench/bench_predict.py [--requests 20]
+
+The requests cycle through real photos (`--images`, the yolov5 samples by default) so they have detections and
+every request runs the whole path: inference, Mongo insert, prediction cache and annotation (unless --no-annotate).
+Every request of every mode sends distinct bytes under its own imgName, so the prediction cache never answers.
+Requests yolo5 answers with 404 (nothing detected) aren't counted in the latencies, they're reported apart.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from pathlib import Path
+
+from PIL import Image
+
+import common
+
+BUCKET = 'bench'
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def load_samples(images_dir, size=None):
+    """
+    The sample photos as JPEG bytes, resized to `size` (width, height) if given
+    :return:
+    """
+    samples = []
+    for path in sorted(Path(images_dir).iterdir()):
+        if path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+            if size:
+                image = image.resize(size)
+            buffer = BytesIO()
+            image.save(buffer, format='JPEG', quality=90)
+            samples.append(buffer.getvalue())
+    return samples
+
+
+def make_images(samples, count, mode):
+    """
+    One image per request, cycling through the samples. A trailing byte string after the JPEG data (ignored by
+    the decoder) makes each one distinct, also across modes, so their hashes differ and none is answered from cache
+    :return:
+    """
+    return [samples[i % len(samples)] + f'{mode}-{i}'.encode() for i in range(count)]
+
+
+def stub_services():
+    """
+    Points boto3 at moto and pymongo at mongomock, before yolo5's app module creates its clients
+    :return: the moto context, to stop at the end
+    """
+    import mongomock
+    import pymongo
+    from moto import mock_aws
+
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'BUCKET_NAME': BUCKET,
+        'MONGO_URI': 'mongodb://stub',
+    })
+    pymongo.MongoClient = mongomock.MongoClient
+    mock = mock_aws()
+    mock.start()
+    import boto3
+    boto3.client('s3').create_bucket(Bucket=BUCKET)
+    return mock
+
+
+def run_mode(client, mode, images, concurrency, annotate=True):
+    """
+    :return: latencies in seconds of the requests answered with a prediction, number of requests answered 404
+    """
+    import boto3
+    names = [f'{mode}-{i}.jpg' for i in range(len(images))]
+    if mode == 's3':
+        s3 = boto3.client('s3')
+        for name, data in zip(names, images):
+            s3.put_object(Bucket=BUCKET, Key=name, Body=data)
+
+    def request(i):
+        start = time.perf_counter()
+        query = {'imgName': names[i], 'annotate': str(annotate).lower()}
+        if mode == 's3':
+            response = client.post('/predict', query_string=query)
+        else:
+            response = client.post('/predict', query_string=query, data=images[i], content_type='application/octet-stream')
+        if response.status_code not in (200, 404):
+            raise RuntimeError(f'/predict failed with {response.status_code}: {response.get_data(as_text=True)}')
+        if response.status_code == 200 and response.get_json()['result_path'].get('cached'):
+            raise RuntimeError(f'{names[i]} was answered from the prediction cache')
+        return response.status_code, time.perf_counter() - start
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(request, range(len(images))))
+    return [latency for status, latency in results if status == 200], sum(status == 404 for status, _ in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--images', default='data/images', help='directory of sample photos (default: the yolov5 samples)')
+    parser.add_argument('--size', help='resize the samples to WIDTHxHEIGHT (default: their own size)')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--no-annotate', action='store_true', help="don't ask yolo5 for the annotated images")
+    parser.add_argument('--modes', default='direct,s3', help='direct: image in the request body, s3: imgName only')
+    parser.add_argument('--app-dir', default=os.getcwd(), help="yolo5 app directory (default: current directory)")
+    common.add_report_args(parser)
+    args = parser.parse_args()
+
+    mock = stub_services()
+    sys.path.insert(0, args.app_dir)
+    start = time.perf_counter()
+    import app as yolo5_app
+    # the model is loaded in the background, the app answers 503 until it's ready - or until its warmup fails
+    deadline = time.monotonic() + 600
+    while not yolo5_app.startup.ready_event.wait(timeout=0.5):
+        if yolo5_app.startup.error or time.monotonic() > deadline:
+            sys.exit(f'yolo5 did not get ready: {yolo5_app.startup.error or "timed out"}')
+    startup_s = time.perf_counter() - start
+    client = yolo5_app.app.test_client()
+
+    samples = load_samples(args.images, tuple(int(v) for v in args.size.split('x')) if args.size else None)
+    if not samples:
+        sys.exit(f'No images in {args.images}')
+    cases = {}
+    try:
+        for mode in args.modes.split(','):
+            images = make_images(samples, args.requests, mode)
+            start = time.perf_counter()
+            latencies, not_found = run_mode(client, mode, images, args.concurrency, not args.no_annotate)
+            if not latencies:
+                sys.exit(f'yolo5 detected nothing in any of the {mode} requests, use other --images')
+            case = common.summarize(latencies, time.perf_counter() - start)
+            # answered without the Mongo insert, cache put and annotation, so they'd skew the latencies
+            case['not_found'] = not_found
+            if not_found:
+                print(f'{mode}: {not_found} of {len(images)} requests had no detections (404)', file=sys.stderr)
+            cases[f'predict[{mode},{args.size or "samples"},c={args.concurrency}]'] = case
+    finally:
+        # the background S3 copies still need the stubbed bucket
+        yolo5_app.persist_executor.shutdown(wait=True)
+        mock.stop()
+
+    for case in cases.values():
+        case['peak_rss_mb'] = common.peak_rss_mb()
+    results = {'benchmark': 'predict', 'startup_s': startup_s, 'startup_phases': yolo5_app.startup.phases, 'cases': cases}
+    sys.exit(common.report(results, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Shared helpers of the benchmark scripts: latency stats, peak RSS, JSON reports and baseline comparison.
+"""
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident set size of the current process, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(latencies, wall_time=None):
+    """
+    :param wall_time: total elapsed seconds when calls ran concurrently, the latencies are summed otherwise
+    :return: throughput and latency percentiles of a list of per-call latencies in seconds
+    """
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'calls': len(latencies),
+        'throughput_per_s': len(latencies) / max(wall_time or sum(latencies), 1e-9),
+        'mean_ms': float(latencies_ms.mean()),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def time_calls(func, repeats, setup=None):
+    """
+    Calls `func(setup())` `repeats` times, only the call itself is timed
+    :return: list of latencies in seconds
+    """
+    latencies = []
+    for _ in range(repeats):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_isolated(func, *args):
+    """
+    Runs `func(*args)` in a fresh process, so the peak RSS it reports belongs to that case only
+    :return: func's return value
+    """
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(func, args)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Flags every case whose p50 latency got slower than the baseline by more than `tolerance` (0.1 = 10%)
+    :return: list of regression descriptions
+    """
+    regressions = []
+    for name, case in results['cases'].items():
+        base = baseline.get('cases', {}).get(name)
+        if not base:
+            continue
+        ratio = case['p50_ms'] / max(base['p50_ms'], 1e-9)
+        case['baseline_p50_ms'] = base['p50_ms']
+        case['p50_ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(f"{name}: p50 {case['p50_ms']:.2f} ms vs baseline {base['p50_ms']:.2f} ms ({ratio:.2f}x)")
+    return regressions
+
+
+def add_report_args(parser):
+    parser.add_argument('--output', help='write the JSON report to this file (stdout otherwise)')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed p50 slowdown vs the baseline (default 0.1 = 10%%)')
+
+
+def report(results, args):
+    """
+    Prints/writes the report and compares it with the baseline
+    :return: process exit code, 1 if a regression was found
+    """
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results['regressions'] = regressions
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
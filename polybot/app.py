@@ -1,12 +1,31 @@
+import time
+IMPORT_START = time.perf_counter()
+
 import flask
 from flask import request
 import os
+import threading
+import uuid
+from loguru import logger
 from bot import Bot
+from clients import get_http_session, get_s3_client
+from worker_pool import UpdateDispatcher, BUSY
+from startup import Startup
+import metrics
 
 app = flask.Flask(__name__)
+metrics.install_log_trace()
+startup = Startup('polybot', started=IMPORT_START)
+startup.record('imports', time.perf_counter() - IMPORT_START)
 
 TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
 TELEGRAM_APP_URL = os.environ['TELEGRAM_APP_URL']
+# number of updates processed concurrently, and how many more may wait before the webhook starts rejecting
+POLYBOT_WORKERS = int(os.getenv('POLYBOT_WORKERS', 4))
+POLYBOT_QUEUE_SIZE = int(os.getenv('POLYBOT_QUEUE_SIZE', 32))
+
+# created in the background by warm_up
+bot = None
 
 
 @app.route('/', methods=['GET'])
@@ -14,15 +33,74 @@ def index():
     return 'Ok'
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # a failed startup is final, failing the liveness probe gets the container restarted
+    if not startup.healthy:
+        return flask.jsonify(startup.report()), 503
+    return 'Ok'
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    return flask.jsonify(startup.report()), 200 if startup.ready else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route(f'/{TELEGRAM_TOKEN}/', methods=['POST'])
 def webhook():
+    if not startup.ready:
+        # Telegram re-delivers the update later
+        return 'Warming up', 503
     req = request.get_json()
-    bot.handle_message(req['message'])
+    if dispatcher.submit(req) == BUSY:
+        # non 2xx makes Telegram back off and re-deliver the update later
+        return 'Busy', 503
     return 'Ok'
 
 
+@app.route('/predictions/callback', methods=['POST'])
+def prediction_callback():
+    # results of the predictions the bot submitted to yolo5 in async mode
+    if bot is None or bot.prediction_jobs is None or not bot.prediction_jobs.complete(request.get_json()):
+        return 'Unknown prediction', 404
+    return 'Ok'
+
+
+def handle_update(update):
+    # one trace id per update, it's logged with every line and passed on to yolo5
+    metrics.new_trace_id(f"{update.get('update_id', 'update')}-{uuid.uuid4().hex[:8]}")
+    if 'message' in update:
+        with metrics.span('handle_message'):
+            bot.handle_message(update['message'])
+
+
+def warm_up():
+    """
+    Registers the webhook and opens the clients while Flask already answers /healthz, then marks the app ready
+    :return:
+    """
+    global bot
+    try:
+        with startup.phase('telegram'):
+            bot = Bot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
+        with startup.phase('clients'):
+            get_http_session()
+            get_s3_client()
+        startup.mark_ready()
+    except Exception as e:
+        logger.exception(f'Error during warmup: {e}')
+        startup.fail(e)
+
+
 if __name__ == "__main__":
-    bot = Bot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
+    dispatcher = UpdateDispatcher(handle_update, workers=POLYBOT_WORKERS, queue_size=POLYBOT_QUEUE_SIZE)
+    metrics.Gauge('polybot_update_queue_depth', 'Accepted updates waiting for a worker', callback=lambda: dispatcher.queued)
+    metrics.Gauge('polybot_updates_in_flight', 'Updates being processed', callback=lambda: dispatcher.running)
+    threading.Thread(target=warm_up, name='warmup', daemon=True).start()
 
     app.run(host='0.0.0.0', port=8443)
-
@@ -1,27 +1,126 @@
 import telebot
+import requests
+import time
 from loguru import logger
 import os
-import time
+from contextlib import nullcontext
+from io import BytesIO
+from telebot import apihelper
 from telebot.types import InputFile
+import img_proc
 from img_proc import Img
+from session_store import SessionStore
+from clients import get_http_session
+from metrics import timed
+from prediction_jobs import PredictionPoller
+from result_cache import ResultCache, result_key
+from yolo_client import YoloClient
+from janitor import DiskJanitor
+import collage
 from collections import Counter
 import json
 
+# smallest longest-side (px) of the photo variant each command needs, other commands get the full resolution photo
+PHOTO_MIN_SIDE = {
+    '/predict': int(os.getenv('PREDICT_MIN_SIDE', 640)),
+}
+# photos are streamed into memory when a command needs them, set to also keep a copy in `photos/` on arrival
+SAVE_PHOTOS_TO_DISK = os.getenv('SAVE_PHOTOS_TO_DISK', 'false').lower() == 'true'
+# filtered images are encoded in memory and uploaded from there, set to also write them to disk
+SAVE_FILTERED_TO_DISK = os.getenv('SAVE_FILTERED_TO_DISK', 'false').lower() == 'true'
+# keeps `photos/` (downloaded photos and filtered outputs) within JANITOR_MAX_BYTES/JANITOR_MAX_FILES
+JANITOR_ENABLED = os.getenv('JANITOR_ENABLED', 'true').lower() == 'true'
+# commands whose result only depends on the photo, the others (e.g. /salt_n_pepper) are never served from the result cache
+CACHEABLE_COMMANDS = ('/blur', '/contour', '/rotate', '/segment', '/pipe', '/horizontal', '/vertical', '/grid')
+# collage commands and their layout, they use every photo of the session (up to a 10 photo media group)
+COLLAGE_LAYOUTS = {
+    '/horizontal': 'row',
+    '/vertical': 'column',
+    '/grid': 'grid',
+}
+# photos of different sizes are scaled down to the smallest ('resize') or kept as they are and padded ('pad')
+COLLAGE_FIT = os.getenv('COLLAGE_FIT', 'resize')
+# attempts at registering the webhook on startup, transient Telegram errors are retried with backoff
+TELEGRAM_STARTUP_ATTEMPTS = int(os.getenv('TELEGRAM_STARTUP_ATTEMPTS', 5))
+# /predict submits the image to yolo5 and returns, the caption is sent once the result is polled or called back
+YOLO_ASYNC = os.getenv('YOLO_ASYNC', 'false').lower() == 'true'
+# where yolo5 posts async results (this app's /predictions/callback), the results are only polled if not set
+YOLO_CALLBACK_URL = os.getenv('YOLO_CALLBACK_URL')
+
 
 class Bot:
 
     def __init__(self, token, telegram_chat_url):
-        self.image_path = ""
-        self.images = []
+        self.token = token
+        # photos each chat is working on, keyed by chat id
+        self.sessions = SessionStore(
+            ttl=int(os.getenv('SESSION_TTL', 3600)),
+            max_sessions=int(os.getenv('SESSION_MAX_CHATS', 1000)),
+            spill_path=os.getenv('SESSION_SPILL_PATH')
+        )
+        # the photos of live sessions are never deleted
+        self.janitor = DiskJanitor.from_env(['photos'], protected=self.sessions.paths)
+        if JANITOR_ENABLED:
+            self.janitor.start()
+        # file_ids of the filtered photos already sent, by source photos + command
+        self.result_cache = ResultCache(
+            max_entries=int(os.getenv('RESULT_CACHE_SIZE', 1024)),
+            db_path=os.getenv('RESULT_CACHE_PATH'),
+            max_disk_entries=int(os.getenv('RESULT_CACHE_DISK_SIZE', 100_000))
+        )
+        # yolo5 replicas, YOLO_SERVICE_URLS (comma separated) or the single YOLO_SERVICE_URL
+        yolo_urls = [url.strip() for url in (os.getenv('YOLO_SERVICE_URLS') or os.getenv('YOLO_SERVICE_URL', '')).split(',')
+                     if url.strip()]
+        self.yolo_client = None
+        if yolo_urls:
+            self.yolo_client = YoloClient(
+                yolo_urls,
+                failure_threshold=int(os.getenv('YOLO_FAILURE_THRESHOLD', 3)),
+                reset_timeout=float(os.getenv('YOLO_RESET_TIMEOUT', 30)),
+                health_interval=float(os.getenv('YOLO_HEALTH_INTERVAL', 10))
+            )
+        self.prediction_jobs = None
+        if YOLO_ASYNC:
+            self.prediction_jobs = PredictionPoller(
+                self.send_prediction_result,
+                self.send_prediction_error,
+                interval=float(os.getenv('YOLO_POLL_INTERVAL', 2)),
+                timeout=float(os.getenv('YOLO_ASYNC_TIMEOUT', 120))
+            )
         # create a new instance of the TeleBot class.
         # all communication with Telegram servers are done using self.telegram_bot_client
         self.telegram_bot_client = telebot.TeleBot(token)
-        # remove any existing webhooks configured in Telegram servers
-        self.telegram_bot_client.remove_webhook()
-        time.sleep(0.5)
-        # set the webhook URL
-        self.telegram_bot_client.set_webhook(url=f'{telegram_chat_url}/{token}/', timeout=60)
-        logger.info(f'Telegram Bot information\n\n{self.telegram_bot_client.get_me()}')
+        self.register_webhook(f'{telegram_chat_url}/{token}/')
+
+    @staticmethod
+    def is_transient_telegram_error(error):
+        if isinstance(error, telebot.apihelper.ApiTelegramException):
+            return error.error_code == 429 or error.error_code >= 500
+        return isinstance(error, requests.RequestException)
+
+    def register_webhook(self, webhook_url, attempts=TELEGRAM_STARTUP_ATTEMPTS, backoff=1.0, max_backoff=30.0):
+        """
+        Sets the webhook URL, unless it's already registered (e.g. by another replica or before a restart).
+        set_webhook replaces any existing webhook, there's no need to remove it first.
+        Network errors, 429 and 5xx from Telegram are retried with exponential backoff, other errors (e.g. a wrong token) aren't
+        :return:
+        """
+        delay = backoff
+        for attempt in range(1, attempts + 1):
+            try:
+                if self.telegram_bot_client.get_webhook_info().url == webhook_url:
+                    logger.info('Telegram webhook already registered')
+                else:
+                    self.telegram_bot_client.set_webhook(url=webhook_url, timeout=60)
+                    logger.info('Telegram webhook registered')
+                return
+            except Exception as e:
+                if attempt == attempts or not self.is_transient_telegram_error(e):
+                    raise
+                logger.warning(f'Error registering the Telegram webhook (attempt {attempt}/{attempts}), '
+                               f'retrying in {delay:.0f}s: {e}')
+                time.sleep(delay)
+                delay = min(delay * 2, max_backoff)
 
     def send_text(self, chat_id, text):
         self.telegram_bot_client.send_message(chat_id, text)
@@ -33,39 +132,115 @@ class Bot:
     def is_current_msg_photo(msg):
         return 'photo' in msg
 
+    @staticmethod
+    def pick_photo_size(sizes, min_side=None):
+        """
+        Picks the smallest variant of a photo (`msg['photo']`, ordered small to large by Telegram) whose longest side is at least `min_side`
+        :return: the full resolution variant if `min_side` is None or no variant is large enough
+        """
+        if min_side is not None:
+            for size in sizes:
+                if max(size['width'], size['height']) >= min_side:
+                    return size
+        return sizes[-1]
+
+    @timed('telegram_download')
+    def stream_photo(self, file_id):
+        """
+        Streams a Telegram file into memory, without going through the disk
+        :return: (BytesIO buffer, Telegram file path)
+        """
+        file_info = self.telegram_bot_client.get_file(file_id)
+        file_url = (apihelper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(self.token, file_info.file_path)
+        buffer = BytesIO()
+        with get_http_session().get(file_url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                buffer.write(chunk)
+        buffer.seek(0)
+        return buffer, file_info.file_path
+
     def download_user_photo(self, msg):
         """
-        Downloads the photos that sent to the Bot to `photos` directory (should be existed)
+        Downloads the photos that sent to the Bot to `photos` directory (created if missing)
         :return:
         """
         if not self.is_current_msg_photo(msg):
             raise RuntimeError(f'Message content of type \'photo\' expected')
 
-        file_info = self.telegram_bot_client.get_file(msg['photo'][-1]['file_id'])
-        data = self.telegram_bot_client.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
+        buffer, file_path = self.stream_photo(msg['photo'][-1]['file_id'])
+        folder_name = os.path.dirname(file_path)
 
-        if not os.path.exists(folder_name):
+        if folder_name and not os.path.exists(folder_name):
             os.makedirs(folder_name)
 
-        with open(file_info.file_path, 'wb') as photo:
-            photo.write(data)
+        with open(file_path, 'wb') as photo:
+            photo.write(buffer.getbuffer())
+
+        return file_path
+
+    def fetch_photo(self, photo, command=None):
+        """
+        Gets a photo of the chat's session, from disk if it was saved there, otherwise streamed from Telegram
+        in the smallest size the command needs
+        :return: (file path or BytesIO buffer, file path)
+        """
+        if photo.get('path') and os.path.exists(photo['path']):
+            return photo['path'], photo['path']
+        size = self.pick_photo_size(photo['sizes'], PHOTO_MIN_SIDE.get(command))
+        return self.stream_photo(size['file_id'])
+
+    def load_photo(self, photo, command=None):
+        """
+        Decodes a photo of the chat's session
+        :return: Img
+        """
+        source, file_path = self.fetch_photo(photo, command)
+        if isinstance(source, BytesIO):
+            return Img(file_path, buffer=source)
+        return Img(file_path)
+
+    @timed('collage')
+    def make_collage(self, photos, command):
+        """
+        Lays out the photos with the collage command's layout, they're downloaded in parallel and decoded
+        straight into the collage
+        :return: Img of the collage, named after the first photo
+        """
+        fetched = list(collage.get_executor().map(lambda photo: self.fetch_photo(photo, command), photos))
+        pixels = collage.compose([source for source, _ in fetched], COLLAGE_LAYOUTS[command], COLLAGE_FIT)
+        return Img(fetched[0][1], pixels=pixels)
 
-        return file_info.file_path
+    @timed('telegram_send')
+    def send_photo_by_id(self, chat_id, file_id, caption=None):
+        """
+        Sends a photo that is already on Telegram servers, no upload needed
+        :return:
+        """
+        self.telegram_bot_client.send_photo(chat_id, file_id, caption=caption)
 
+    @timed('telegram_send')
     def send_photo(self, chat_id, image_path, caption=None):
-        if not os.path.exists(image_path):
+        """
+        Uploads a photo, `image_path` is either a file path or an in-memory buffer (e.g. from Img.encode)
+        :return:
+        """
+        if isinstance(image_path, BytesIO):
+            photo = InputFile(image_path, file_name=getattr(image_path, 'name', None))
+        elif not os.path.exists(image_path):
             raise RuntimeError("Image path doesn't exist")
+        else:
+            photo = InputFile(image_path)
 
         if caption is None:
-            self.telegram_bot_client.send_photo(
+            return self.telegram_bot_client.send_photo(
                 chat_id,
-                InputFile(image_path)
+                photo
             )
         else:
-            self.telegram_bot_client.send_photo(
+            return self.telegram_bot_client.send_photo(
                 chat_id,
-                InputFile(image_path),
+                photo,
                 caption=caption
             )
 
@@ -74,7 +249,8 @@ class Bot:
         Determines what to do based on the message received from the user:
         Ignore files without a specific processing function.
         Reply to any text message with a qute of the message and sending user name.
-        If the message has a photo in it - determines whether there's 1 or 2 images in the message and calls the menu function accordingly.
+        If the message has a photo in it - adds it to the chat's session (a single photo, or up to 10 photos of a media group)
+        and sends the command menu once: for a single photo, or when the second photo of a media group arrives.
         :return:
         """
         logger.info(f'Incoming message: {msg}')
@@ -95,14 +271,14 @@ class Bot:
             elif 'document' in msg:
                 pass
             elif 'photo' in msg:
-                chat_id = msg['chat']['id']
-                if 'media_group_id' in msg:
-                    self.image_path = self.download_user_photo(msg)
-                    self.images.append(self.image_path)
-                    if len(self.images) == 2:
-                        self.send_photo_command_menu(chat_id)
-                else:
-                    self.image_path = self.download_user_photo(msg)
+                media_group_id = msg.get('media_group_id')
+                # only the photo's file ids are kept, it is downloaded once a command needs it
+                photo = {'sizes': msg['photo']}
+                if SAVE_PHOTOS_TO_DISK:
+                    photo['path'] = self.download_user_photo(msg)
+                images_count = self.sessions.add_image(chat_id, photo, media_group_id)
+                # a media group arrives as one message per photo, send the menu once
+                if media_group_id is None or images_count == 2:
                     self.send_photo_command_menu(chat_id)
             elif 'audi' in msg:
                 pass
@@ -123,21 +299,61 @@ class Bot:
         command_menu += "/contour - Apply contour filter\n"
         command_menu += "/rotate - Rotate the image\n"
         command_menu += "/salt_n_pepper - Apply salt and pepper noise\n"
-        command_menu += "/concat - Requires 2 Images to be uploaded, & collages them together\n"
+        command_menu += "/concat - Requires 2 to 10 Images to be uploaded, & collages them together\n"
         command_menu += "/segment - Segment the image\n"
         command_menu += "/predict - Identify the image content using YOLO5\n"
+        command_menu += "/pipe - Chain filters in one go, e.g. /pipe blur contour rotate\n"
         self.send_text(chat_id, command_menu)
 
     def send_photo_command_submenu(self, chat_id):
         """
-        Sends a links submenu of directions options when the user clicks the concat filter option
+        Sends a links submenu of layout options when the user clicks the concat filter option
         :return:
         """
-        command_submenu = "Please reply with the desired direction:\n"
+        command_submenu = "Please reply with the desired layout:\n"
         command_submenu += "/horizontal\n"
         command_submenu += "/vertical\n"
+        command_submenu += "/grid\n"
         self.send_text(chat_id, command_submenu)
 
+    @staticmethod
+    def filter_result_key(command, photos, args=()):
+        """
+        Result cache key of a filter command on the given session photos
+        :return: None if the result can't be cached (random filters without a seed, photos without a file_unique_id)
+        """
+        if command not in CACHEABLE_COMMANDS:
+            return None
+        if command == '/pipe':
+            for step in args:
+                name, *step_args = step.lstrip('/').split(':')
+                # salt_n_pepper is only repeatable with an explicit seed, its third argument
+                if name == 'salt_n_pepper' and len(step_args) < 3:
+                    return None
+        unique_ids = [photo['sizes'][-1].get('file_unique_id') for photo in photos]
+        if not all(unique_ids):
+            return None
+        # the same filter sent with other output settings is a different photo
+        encoding = (img_proc.OUTPUT_FORMAT, img_proc.OUTPUT_QUALITY, img_proc.PNG_COMPRESS_LEVEL)
+        return result_key(unique_ids, command, [*args, *encoding])
+
+    def send_cached_result(self, chat_id, key):
+        """
+        Re-sends the photo cached under `key`
+        :return: True if it was sent, False on a miss or if Telegram refused the file_id
+        """
+        file_id = self.result_cache.get(key) if key else None
+        if file_id is None:
+            return False
+        try:
+            self.send_photo_by_id(chat_id, file_id)
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning(f'Cached result {file_id} was refused, processing again: {e}')
+            self.result_cache.discard(key)
+            return False
+        logger.info(f'Sent cached result {key}')
+        return True
+
     def handle_filter_command(self, msg):
         """
         Handles the user's choice of a filter by calling the corresponding function with a filter command
@@ -146,25 +362,29 @@ class Bot:
         chat_id = msg['chat']['id']
         command = msg['text'].split()[0]
         error_found = False
-        processed_image_path = ""
+        processed_image = None
+        images = self.sessions.get_images(chat_id)
+
+        # the same filter on the same photo (e.g. forwarded in a group) re-sends the photo we already made
+        if command in COLLAGE_LAYOUTS:
+            cache_key = self.filter_result_key(command, images, [COLLAGE_FIT, collage.MAX_SIDE]) if len(images) >= 2 else None
+        else:
+            cache_key = self.filter_result_key(command, images[-1:], msg['text'].split()[1:]) if images else None
+        if cache_key and self.send_cached_result(chat_id, cache_key):
+            self.sessions.clear(chat_id)
+            return
 
         if command == '/concat':
             self.send_photo_command_submenu(chat_id)
-        elif command == '/horizontal' or command == '/vertical':
-            if self.images:
-                img1 = Img(self.images[0])
-                img2 = Img(self.images[1])
-                result = img1.concat(img2, command)
-                if result[1] == 500:
-                    self.send_text(chat_id, result[0])
-                    self.image_path = ""
-                    self.images = []
-                    return
-                processed_image_path = img1.save_img()
+        elif command in COLLAGE_LAYOUTS:
+            if len(images) >= 2:
+                img = self.make_collage(images, command)
+                processed_image = img.save_img() if SAVE_FILTERED_TO_DISK else img.encode()
             else:
                 error_found = True
-        elif self.image_path:
-            img = Img(self.image_path)
+        elif images:
+            photo = images[-1]
+            img = self.load_photo(photo, command)
             if command == '/blur':
                 img.blur()
             elif command == '/contour':
@@ -175,16 +395,32 @@ class Bot:
                 img.salt_n_pepper()
             elif command == '/segment':
                 img.segment()
+            elif command == '/pipe':
+                try:
+                    img.apply_pipeline(msg['text'].split()[1:])
+                except ValueError as e:
+                    self.send_text(chat_id, f"{e}. Usage: /pipe blur contour rotate (optional args: blur:8, salt_n_pepper:0.05:0.05:42)")
+                    return
             elif command == '/predict':
                 try:
-                    yolo_service_url = os.environ['YOLO_SERVICE_URL']
-                    image_path = os.path.abspath(self.image_path)
-                    image_name = os.path.basename(self.image_path)
-                    prediction_summary = img.upload_and_predict(yolo_service_url, image_path, image_name)
+                    if self.yolo_client is None:
+                        raise RuntimeError('YOLO_SERVICE_URLS or YOLO_SERVICE_URL is not set')
+                    image_name = img.path.name
+                    file_id = photo['sizes'][-1]['file_id']
+                    if self.prediction_jobs is not None:
+                        yolo_service_url, response = self.yolo_client.call(lambda url: (url, img.upload_and_predict(
+                            url, image_name, submit=True, callback_url=YOLO_CALLBACK_URL)))
+                        if 'prediction_id' in response and 'result_path' not in response:
+                            # the caption is sent by the poller once yolo5 is done
+                            self.prediction_jobs.track(response['prediction_id'], yolo_service_url, (chat_id, file_id))
+                            self.sessions.clear(chat_id)
+                            return
+                        prediction_summary = response
+                    else:
+                        prediction_summary = self.yolo_client.call(lambda url: img.upload_and_predict(url, image_name))
                     caption = self.prediction_decode(prediction_summary)
-                    self.send_photo(chat_id, image_path, caption)
-                    self.images = []
-                    self.image_path = ""
+                    self.send_photo_by_id(chat_id, file_id, caption)
+                    self.sessions.clear(chat_id)
                     return
                 except Exception as e:
                     logger.error(f"Error during prediction: {e}")
@@ -194,11 +430,27 @@ class Bot:
                 # Invalid filter command
                 self.send_text(chat_id, "Invalid filter command. Please choose from the command menu.")
                 return
-            processed_image_path = img.save_img()
-        if error_found is False and processed_image_path:
-            self.send_photo(chat_id, processed_image_path)
-            self.image_path = ""
-            self.images = []
+            processed_image = img.save_img() if SAVE_FILTERED_TO_DISK else img.encode()
+        if error_found is False and processed_image:
+            # a filtered image saved to disk is kept until it's uploaded
+            with nullcontext() if isinstance(processed_image, BytesIO) else self.janitor.pin(processed_image):
+                sent = self.send_photo(chat_id, processed_image)
+            if cache_key and sent is not None and sent.photo:
+                self.result_cache.put(cache_key, sent.photo[-1].file_id)
+            self.sessions.clear(chat_id)
+
+    def send_prediction_result(self, context, prediction_summary):
+        """
+        Sends the caption of an async prediction, `context` is the (chat id, photo file id) the job was tracked with
+        :return:
+        """
+        chat_id, file_id = context
+        self.send_photo_by_id(chat_id, file_id, self.prediction_decode(prediction_summary))
+
+    def send_prediction_error(self, context, message):
+        chat_id, _ = context
+        logger.error(f"Error during prediction: {message}")
+        self.send_text(chat_id, "Error during prediction. Please try again.")
 
     @staticmethod
     def prediction_decode(prediction_summary):
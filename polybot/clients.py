@@ -0,0 +1,53 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_lock = threading.Lock()
+_s3_client = None
+_http_session = None
+
+
+def get_s3_client():
+    """
+    Process-wide S3 client, boto3 clients are thread safe and keep their connection pool between calls
+    :return:
+    """
+    global _s3_client
+    with _lock:
+        if _s3_client is None:
+            # imported on first use, boto3 takes a while to import and isn't needed to start serving
+            import boto3
+            from botocore.config import Config
+            _s3_client = boto3.client('s3', config=Config(
+                max_pool_connections=int(os.getenv('S3_MAX_POOL_CONNECTIONS', 20)),
+                retries={'max_attempts': 3, 'mode': 'standard'}
+            ))
+        return _s3_client
+
+
+def get_http_session():
+    """
+    Process-wide keep-alive session for the calls to yolo5, with retries and backoff on connection errors.
+    Only GETs are also retried on read errors and 502/503/504: a POST (/predict, /predict/async) that reached yolo5
+    may have run the inference already, and failing over to another replica is YoloClient's job
+    :return:
+    """
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            retry = Retry(
+                total=int(os.getenv('HTTP_RETRIES', 3)),
+                backoff_factor=float(os.getenv('HTTP_BACKOFF', 0.3)),
+                status_forcelist=(502, 503, 504),
+                # urllib3 retries connection errors for any method, read and status retries only for these
+                allowed_methods=frozenset(['GET']),
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv('HTTP_POOL_SIZE', 16)), max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
@@ -0,0 +1,150 @@
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import numpy as np
+from img_proc import rgb2gray
+from tiling import Tiler
+
+# how the images are laid out: a grid of about sqrt(n) columns, a single row or a single column
+LAYOUTS = ('grid', 'row', 'column')
+# what is done with images of different sizes: scaled down to match the smallest, or kept as they are and centered
+FITS = ('resize', 'pad')
+# longest side (px) of a collage, larger layouts are scaled down as a whole (Telegram refuses photos over 10000px width + height)
+MAX_SIDE = int(os.getenv('COLLAGE_MAX_SIDE', 4096))
+# threads decoding the images of a collage, Pillow releases the GIL while decoding and resizing
+DECODE_WORKERS = int(os.getenv('COLLAGE_DECODE_WORKERS', 4))
+# gray level of the padding and the gaps (white)
+BACKGROUND = 255.0
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    """
+    Process-wide thread pool of DECODE_WORKERS threads, for the downloads and decodes of the collage inputs
+    :return: ThreadPoolExecutor
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(DECODE_WORKERS, 1), thread_name_prefix='collage')
+        return _executor
+
+
+def plan(sizes, layout='grid', fit='resize', columns=None, gap=0, max_side=MAX_SIDE):
+    """
+    Places images of the given (height, width) sizes on a canvas, images are only ever scaled down.
+    Every image gets a cell, the cells of a row share its height and the cells of a column share its width;
+    an image smaller than its cell is centered in it.
+    :return: canvas (height, width), the (top, left, height, width) of every cell - empty trailing grid cells included -
+    and the (top, left, height, width) of every image
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown collage layout {layout}, expected one of {', '.join(LAYOUTS)}")
+    if fit not in FITS:
+        raise ValueError(f"Unknown collage fit {fit}, expected one of {', '.join(FITS)}")
+    if not sizes:
+        raise ValueError('A collage needs at least one image')
+
+    count = len(sizes)
+    if layout == 'row':
+        cols = count
+    elif layout == 'column':
+        cols = 1
+    else:
+        cols = min(columns or math.ceil(math.sqrt(count)), count)
+    rows = math.ceil(count / cols)
+
+    min_height = min(height for height, _ in sizes)
+    min_width = min(width for _, width in sizes)
+    scales = []
+    for height, width in sizes:
+        if fit == 'pad':
+            scales.append(1.0)
+        elif layout == 'row':
+            scales.append(min_height / height)
+        elif layout == 'column':
+            scales.append(min_width / width)
+        else:
+            scales.append(min(min_height / height, min_width / width))
+
+    def tracks(boxes):
+        row_heights = [max(boxes[i][0] for i in range(r * cols, min((r + 1) * cols, count))) for r in range(rows)]
+        col_widths = [max(boxes[i][1] for i in range(c, count, cols)) for c in range(cols)]
+        return row_heights, col_widths
+
+    boxes = [(max(1, round(height * scale)), max(1, round(width * scale))) for (height, width), scale in zip(sizes, scales)]
+    row_heights, col_widths = tracks(boxes)
+    if max_side:
+        # the gaps keep their size, only the images are scaled down
+        factor = min((max_side - gap * (rows - 1)) / sum(row_heights), (max_side - gap * (cols - 1)) / sum(col_widths))
+        if factor < 1:
+            # floored: rounded sizes could add up past max_side
+            boxes = [(max(1, math.floor(height * factor)), max(1, math.floor(width * factor))) for height, width in boxes]
+            row_heights, col_widths = tracks(boxes)
+
+    tops = [sum(row_heights[:r]) + gap * r for r in range(rows)]
+    lefts = [sum(col_widths[:c]) + gap * c for c in range(cols)]
+    cells = [(tops[i // cols], lefts[i % cols], row_heights[i // cols], col_widths[i % cols]) for i in range(rows * cols)]
+    placed = []
+    for (top, left, cell_height, cell_width), (height, width) in zip(cells, boxes):
+        placed.append((top + (cell_height - height) // 2, left + (cell_width - width) // 2, height, width))
+    canvas = (sum(row_heights) + gap * (rows - 1), sum(col_widths) + gap * (cols - 1))
+    return canvas, cells, placed
+
+
+def _paint(out, image, cell, box):
+    """
+    Decodes `image` straight at the size of its box and writes it into `out`, then pads the rest of its cell
+    :return:
+    """
+    top, left, height, width = box
+    # JPEGs are decoded at the smallest 1/2^k scale still covering the box, the resize is then only a small step
+    image.draft('RGB', (width, height))
+    rgb = image.convert('RGB')
+    if rgb.size != (width, height):
+        rgb = rgb.resize((width, height), Image.BILINEAR)
+    out[top:top + height, left:left + width] = rgb2gray(np.asarray(rgb))
+
+    cell_top, cell_left, cell_height, cell_width = cell
+    out[cell_top:top, cell_left:cell_left + cell_width] = BACKGROUND
+    out[top + height:cell_top + cell_height, cell_left:cell_left + cell_width] = BACKGROUND
+    out[top:top + height, cell_left:left] = BACKGROUND
+    out[top:top + height, left + width:cell_left + cell_width] = BACKGROUND
+
+
+def compose(sources, layout='grid', fit='resize', columns=None, gap=0, max_side=MAX_SIDE, tiler=None):
+    """
+    Lays out images (file paths or file-like objects) on one canvas. Only the headers are read to plan the layout,
+    then the images are decoded in parallel, each one resized and written straight into its place in the
+    preallocated canvas - no intermediate rows nor copies of the whole collage.
+    :return: (height, width) float64 grayscale array, as Img.pixels
+    """
+    images = []
+    try:
+        for source in sources:
+            images.append(Image.open(source))
+        canvas, cells, boxes = plan([(image.height, image.width) for image in images], layout, fit, columns, gap, max_side)
+        out = (tiler or Tiler.from_env()).allocate(canvas)
+
+        # the gaps and the empty trailing cells, every other pixel is written by exactly one image
+        for top, left, height, width in cells[len(images):]:
+            out[top:top + height, left:left + width] = BACKGROUND
+        if gap:
+            # the cells of a row (column) share its top and height (left and width), the last one has no gap after it
+            for bottom in sorted({top + height for top, _, height, _ in cells})[:-1]:
+                out[bottom:bottom + gap] = BACKGROUND
+            for right in sorted({left + width for _, left, _, width in cells})[:-1]:
+                out[:, right:right + gap] = BACKGROUND
+
+        # cells never overlap, so the threads write the canvas without locking
+        futures = [get_executor().submit(_paint, out, image, cell, box) for image, cell, box in zip(images, cells, boxes)]
+        for future in futures:
+            future.result()
+    finally:
+        for image in images:
+            image.close()
+    return out
@@ -1,12 +1,17 @@
 from pathlib import Path
-from matplotlib.image import imread, imsave
-import random
+from io import BytesIO
+from PIL import Image
+import numpy as np
 import requests
 import os
 from loguru import logger
-import boto3
 from botocore.exceptions import ClientError
 import json
+import hashlib
+from clients import get_s3_client, get_http_session
+from tiling import Tiler
+from parallel import get_parallel_backend
+from metrics import span, timed, current_trace_id, TRACE_HEADER
 
 def rgb2gray(rgb):
     r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
@@ -14,135 +19,354 @@ def rgb2gray(rgb):
     return gray
 
 
+def decode_image(source):
+    """
+    Decodes an image file or an in-memory buffer with Pillow
+    :return: (height, width, 3) uint8 RGB array
+    """
+    with Image.open(source) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+# matplotlib's 'gray' colormap as bytes, including its float truncation, so the output stays byte-identical to imsave
+GRAY_LUT = (np.linspace(0, 1, 256) * 255).astype(np.uint8)
+
+
+def to_gray8(pixels):
+    """
+    Scales the pixels to 8-bit the way matplotlib's imsave(cmap='gray') does: darkest pixel black, brightest white
+    :return: uint8 array
+    """
+    low, high = pixels.min(), pixels.max()
+    if high == low:
+        return np.zeros(pixels.shape, dtype=np.uint8)
+    scaled = (pixels - low) / (high - low) * 256
+    return GRAY_LUT[np.minimum(scaled, 255).astype(np.uint8)]
+
+
+def encode_png(image, fp, quality, compress_level):
+    image.save(fp, format='PNG', compress_level=compress_level)
+
+
+def encode_jpeg(image, fp, quality, compress_level):
+    image.save(fp, format='JPEG', quality=quality)
+
+
+def encode_webp(image, fp, quality, compress_level):
+    image.save(fp, format='WEBP', quality=quality)
+
+
+# output encoders by format, see register_encoder
+ENCODERS = {
+    'png': encode_png,
+    'jpeg': encode_jpeg,
+    'jpg': encode_jpeg,
+    'webp': encode_webp,
+}
+# output format (the input file's format if not set), JPEG/WebP quality and PNG compression level (0-9) used by Img.encode
+OUTPUT_FORMAT = os.getenv('IMG_OUTPUT_FORMAT')
+OUTPUT_QUALITY = int(os.getenv('IMG_OUTPUT_QUALITY', 90))
+PNG_COMPRESS_LEVEL = int(os.getenv('IMG_PNG_COMPRESS_LEVEL', 1))
+
+
+def register_encoder(fmt, encoder):
+    """
+    Adds an output format, `encoder(image, fp, quality, compress_level)` writes a grayscale PIL image to the file object `fp`
+    :return:
+    """
+    ENCODERS[fmt.lower()] = encoder
+
+
+# seconds to wait for yolo5 to answer, /predict answers only once the inference is done
+YOLO_TIMEOUT = float(os.getenv('YOLO_TIMEOUT', 60))
+
+# filters that can be chained with Img.apply_pipeline, with the name and type of their optional arguments
+PIPELINE_FILTERS = {
+    'blur': (('blur_level', int),),
+    'contour': (),
+    'rotate': (),
+    'salt_n_pepper': (('salt_prob', float), ('pepper_prob', float), ('seed', int)),
+    'segment': (),
+}
+DEFAULT_BLUR_LEVEL = 16
+
+
+def parse_pipeline_step(step, height, width):
+    """
+    Parses a pipeline step, e.g. 'blur:8', and checks it can run on a `height` x `width` image
+    :return: (filter name, arguments, (height, width) of the image after the step)
+    """
+    name, *raw_args = step.lstrip('/').split(':')
+    if name not in PIPELINE_FILTERS:
+        raise ValueError(f"Unknown filter in pipeline: {name}")
+    spec = PIPELINE_FILTERS[name]
+    usage = ':'.join([name, *(f'<{arg}>' for arg, _ in spec)])
+    if len(raw_args) > len(spec):
+        raise ValueError(f"Too many arguments in {step}, expected {usage}")
+    args = []
+    for raw, (arg, kind) in zip(raw_args, spec):
+        try:
+            args.append(kind(raw))
+        except ValueError:
+            raise ValueError(f"{arg} in {step} must be {'an integer' if kind is int else 'a number'}, expected {usage}")
+    if height == 0 or width == 0:
+        raise ValueError(f"Image is empty before {step}")
+
+    if name == 'blur':
+        blur_level = args[0] if args else DEFAULT_BLUR_LEVEL
+        if not 1 <= blur_level <= min(height, width):
+            raise ValueError(f"blur_level in {step} must be between 1 and {min(height, width)} "
+                             f"for the {width}x{height} image it gets")
+        return name, args, (height - blur_level + 1, width - blur_level + 1)
+    if name == 'salt_n_pepper':
+        for value, (arg, kind) in zip(args, spec):
+            if kind is float and not 0 <= value <= 1:
+                raise ValueError(f"{arg} in {step} must be between 0 and 1")
+            if kind is int and value < 0:
+                raise ValueError(f"{arg} in {step} must not be negative")
+        return name, args, (height, width)
+    if name == 'contour':
+        if width < 2:
+            raise ValueError(f"Image is too narrow for {step}, it needs at least 2 columns")
+        return name, args, (height, width - 1)
+    if name == 'rotate':
+        return name, args, (width, height)
+    return name, args, (height, width)
+
+
 class Img:
 
-    def __init__(self, path):
+    def __init__(self, path, buffer=None, tiler=None, parallel=None, pixels=None):
         """
-        Do not change the constructor implementation
+        Loads the image once into a contiguous grayscale float array (`self.pixels`).
+        `self.data` is kept as a list-of-lists view for existing callers.
+        If `buffer` (bytes or a file-like object) is given the image is decoded from it and `path` is only used to name the output.
+        If `pixels` (an already decoded grayscale array, e.g. a collage) is given nothing is decoded, `path` only names the output.
+        `tiler` sets the memory budget of the filters, by default it's configured from IMG_TILE_BUDGET / IMG_SCRATCH_DIR.
+        `parallel` is a ParallelBackend for large images, by default the one enabled by IMG_PARALLEL_WORKERS (if any).
         """
         self.path = Path(path)
-        self.data = rgb2gray(imread(path)).tolist()
+        self.tiler = tiler or Tiler.from_env()
+        self.parallel = parallel or get_parallel_backend()
+        if pixels is not None:
+            self.source_bytes = None
+            self.pixels = np.ascontiguousarray(pixels, dtype=np.float64)
+        else:
+            with span('decode'):
+                if buffer is None:
+                    self.source_bytes = None
+                    self.pixels = np.ascontiguousarray(rgb2gray(decode_image(path)), dtype=np.float64)
+                else:
+                    self.source_bytes = buffer if isinstance(buffer, bytes) else buffer.getvalue()
+                    self.pixels = np.ascontiguousarray(rgb2gray(decode_image(BytesIO(self.source_bytes))), dtype=np.float64)
         self.bucket_name = os.getenv('BUCKET_NAME')
 
-    def save_img(self):
+    @property
+    def data(self):
         """
-        Do not change the below implementation
+        List-compatible copy of the pixel buffer, mutating it won't change the image - assign it back instead
+        :return:
         """
-        new_path = self.path.with_name(self.path.stem + '_filtered' + self.path.suffix)
-        imsave(new_path, self.data, cmap='gray')
-        return new_path
+        return self.pixels.tolist()
+
+    @data.setter
+    def data(self, value):
+        self.pixels = np.ascontiguousarray(value, dtype=np.float64)
+
+    def _use_parallel(self):
+        return self.parallel is not None and self.parallel.worth_it(self.pixels)
 
-    def blur(self, blur_level=16):
+    @property
+    def height(self):
+        return self.pixels.shape[0]
+
+    @property
+    def width(self):
+        return self.pixels.shape[1]
+
+    @timed('encode')
+    def encode(self, fmt=None, quality=None, compress_level=None):
         """
-        Applies a blur filter on the image and saves it to be sent back to the user
-        :return:
+        Encodes the image as 8-bit grayscale into memory
+        :return: BytesIO, its `name` is the output file name
         """
-        height = len(self.data)
-        width = len(self.data[0])
-        filter_sum = blur_level ** 2
+        fmt = (fmt or OUTPUT_FORMAT or self.path.suffix.lstrip('.') or 'png').lower()
+        if fmt not in ENCODERS:
+            raise ValueError(f"Unsupported output format: {fmt}")
+
+        buffer = BytesIO()
+        ENCODERS[fmt](
+            Image.fromarray(to_gray8(self.pixels)),
+            buffer,
+            quality=quality or OUTPUT_QUALITY,
+            compress_level=PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+        )
+        buffer.name = f'{self.path.stem}_filtered.{fmt}'
+        buffer.seek(0)
+        return buffer
 
-        result = []
-        for i in range(height - blur_level + 1):
-            row_result = []
-            for j in range(width - blur_level + 1):
-                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
-                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
-                row_result.append(average)
-            result.append(row_result)
+    def save_img(self, fmt=None, quality=None, compress_level=None):
+        """
+        Encodes the image and writes it next to the original, as <name>_filtered.<format>
+        :return: path of the written file
+        """
+        buffer = self.encode(fmt, quality, compress_level)
+        new_path = self.path.with_name(buffer.name)
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        new_path.write_bytes(buffer.getbuffer())
+        return new_path
 
-        self.data = result
+    @timed('filter.blur')
+    def blur(self, blur_level=DEFAULT_BLUR_LEVEL):
+        """
+        Applies a box blur filter on the image, the result shrinks by blur_level - 1 pixels on each axis
+        :return:
+        """
+        if self.height < blur_level or self.width < blur_level:
+            raise RuntimeError("Image is smaller than the blur level")
+        if self._use_parallel():
+            self.pixels = self.parallel.blur(self.pixels, blur_level)
+        else:
+            self.pixels = self.tiler.blur(self.pixels, blur_level)
 
+    @timed('filter.contour')
     def contour(self):
         """
-        Applies a contour filter on the image and saves it to be sent back to the user
+        Applies a contour filter on the image (absolute difference between horizontal neighbours)
         :return:
         """
-        for i, row in enumerate(self.data):
-            res = []
-            for j in range(1, len(row)):
-                res.append(abs(row[j-1] - row[j]))
-
-            self.data[i] = res
+        if self._use_parallel():
+            self.pixels = self.parallel.contour(self.pixels)
+        else:
+            self.pixels = self.tiler.contour(self.pixels)
 
+    @timed('filter.rotate')
     def rotate(self):
         """
-        Rotates the image and saves it to be sent back to the user
+        Rotates the image 90 degrees clockwise
         :return:
         """
-        if not self.data:
+        if self.pixels.size == 0:
             raise RuntimeError("Image data is empty")
-        self.data = [list(row) for row in zip(*self.data[::-1])]
+        self.pixels = self.tiler.rotate(self.pixels)
 
-    def salt_n_pepper(self, salt_prob=0.05, pepper_prob=0.05):
+    @timed('filter.salt_n_pepper')
+    def salt_n_pepper(self, salt_prob=0.05, pepper_prob=0.05, seed=None):
         """
-        Applies a salt & pepper filter on the image and saves it to be sent back to the user
+        Applies a salt & pepper filter on the image, pass a seed for a reproducible result
         :return:
         """
-        height = len(self.data)
-        width = len(self.data[0])
-        for i in range(height):
-            for j in range(width):
-                rand = random.random()
-                if rand < salt_prob:
-                    self.data[i][j] = 255
-                elif rand < salt_prob + pepper_prob:
-                    self.data[i][j] = 0
+        if self._use_parallel():
+            self.pixels = self.parallel.salt_n_pepper(self.pixels, salt_prob, pepper_prob, seed)
+        else:
+            self.pixels = self.tiler.salt_n_pepper(self.pixels, salt_prob, pepper_prob, seed)
 
+    @timed('filter.concat')
     def concat(self, other_img, direction='/horizontal'):
         """
-        merges 2 images into a collage either horizontally or vertically according to the user's choice and saves it to be sent back to the user
+        merges 2 images into a collage either horizontally or vertically according to the user's choice
         :return:
         """
         if direction == '/horizontal':
-            try:
-                if len(self.data) != len(other_img.data):
-                    raise RuntimeError("Images must have the same height for horizontal concatenation")
-                self.data = [row1 + row2 for row1, row2 in zip(self.data, other_img.data)]
-            except RuntimeError as e:
-                error_message = str(e)
-                return error_message, 500
+            if self.height != other_img.height:
+                return "Images must have the same height for horizontal concatenation", 500
+            self.pixels = self.tiler.concat(self.pixels, other_img.pixels, axis=1)
         elif direction == '/vertical':
-            try:
-                if len(self.data[0]) != len(other_img.data[0]):
-                    raise RuntimeError("Images must have the same width for vertical concatenation")
-                self.data += other_img.data
-            except RuntimeError as e:
-                error_message = str(e)
-                return error_message, 500
+            if self.width != other_img.width:
+                return "Images must have the same width for vertical concatenation", 500
+            self.pixels = self.tiler.concat(self.pixels, other_img.pixels, axis=0)
         else:
             return "Invalid direction for concatenation. Must be 'horizontal' or 'vertical'.", 500
         return "Ok", 200
 
+    @timed('filter.segment')
     def segment(self):
         """
-        Applies a segment filter on the image and saves it to be sent back to the user
+        Applies a segment filter on the image: pixels below the mean become black, the rest white
         :return:
         """
-        if not self.data:
+        if self.pixels.size == 0:
             raise RuntimeError("Image data is empty")
-        total_pixels = sum(sum(row) for row in self.data)
-        average = total_pixels // (len(self.data) * len(self.data[0]))
-        for i, row in enumerate(self.data):
-            self.data[i] = [0 if pixel < average else 255 for pixel in row]
+        if self._use_parallel():
+            self.pixels = self.parallel.segment(self.pixels)
+        else:
+            self.pixels = self.tiler.segment(self.pixels)
+
+    def apply_pipeline(self, steps):
+        """
+        Runs a chain of filters in memory, e.g. ['blur:8', 'contour', 'rotate'].
+        Each step is a filter name with optional ':'-separated numeric arguments.
+        The image is decoded once and only the final result should be saved.
+        A step that can't run (bad arguments, a blur larger than the image it gets) raises ValueError.
+        :return:
+        """
+        if not steps:
+            raise ValueError("Pipeline is empty")
+        parsed = []
+        height, width = self.pixels.shape
+        for step in steps:
+            name, args, (height, width) = parse_pipeline_step(step, height, width)
+            parsed.append((name, args))
+        # all steps are checked before running any, so a bad step doesn't leave the image half processed
+        for name, args in parsed:
+            getattr(self, name)(*args)
 
-    def upload_and_predict(self, yolo_service_url, image_path, image_name):
+    def upload_and_predict(self, yolo_service_url, image_name, image_path=None, submit=False, callback_url=None):
+        """
+        Sends the original image (read from `image_path`, or the bytes the image was decoded from) to yolo5.
+        With `submit` the image is queued on yolo5's /predict/async instead of waiting for the inference,
+        yolo5 then posts the result to `callback_url` (if given) and answers status polls.
+        :return: yolo5 prediction response, or the submitted job (`prediction_id`) unless a cached prediction answered
+        """
         if not image_name:
             raise ValueError("Image name is empty")
+
+        if image_path is not None:
+            img_bytes = Path(image_path).read_bytes()
+        elif self.source_bytes is not None:
+            img_bytes = self.source_bytes
+        else:
+            img_bytes = self.path.read_bytes()
+
+        # yolo5 keeps predictions by image content, a known image needs no upload nor inference
+        img_hash = hashlib.sha256(img_bytes).hexdigest()
+        trace_headers = {TRACE_HEADER: current_trace_id()}
         try:
-            self.upload_to_s3(image_path, image_name)
-            logger.info(f"Successfully uploaded {image_name} to S3")
-        except Exception as e:
-            logger.exception(f'<red>Error uploading image to S3: {e}</red>')
-            raise
+            with span('yolo_cache_lookup'):
+                response = get_http_session().get(f'{yolo_service_url}/predictions/by-hash/{img_hash}',
+                                                  headers=trace_headers, timeout=YOLO_TIMEOUT)
+            if response.status_code == 200:
+                logger.info(f"Cached prediction found for image: {image_name}")
+                return json.loads(response.text)
+        except requests.RequestException as e:
+            logger.warning(f"Error looking up cached prediction: {e}")
+
+        # in direct mode the bytes go straight to yolo5, which copies them to S3 itself off the critical path
+        direct_upload = os.getenv('YOLO_DIRECT_UPLOAD', 'true').lower() == 'true'
+        if not direct_upload:
+            try:
+                self.upload_bytes_to_s3(img_bytes, image_name)
+                logger.info(f"Successfully uploaded {image_name} to S3")
+            except Exception as e:
+                logger.exception(f'<red>Error uploading image to S3: {e}</red>')
+                raise
 
         logger.info(f"Starting prediction for image: {image_name}")
         logger.info(f"YOLO service URL: {yolo_service_url}")
 
         # Send a request to the YOLO5 service for prediction
-        full_url = f'{yolo_service_url}/predict'
+        full_url = f'{yolo_service_url}/predict/async' if submit else f'{yolo_service_url}/predict'
         logger.info(f"Sending prediction request to: {full_url}")
         try:
-            response = requests.post(full_url, params={'imgName': image_name})
+            params = {'imgName': image_name, 'imgHash': img_hash}
+            if callback_url:
+                params['callbackUrl'] = callback_url
+            with span('yolo_submit' if submit else 'yolo_request'):
+                if direct_upload:
+                    response = get_http_session().post(full_url, params=params, data=img_bytes, timeout=YOLO_TIMEOUT,
+                                                       headers={**trace_headers, 'Content-Type': 'application/octet-stream'})
+                else:
+                    response = get_http_session().post(full_url, params=params, headers=trace_headers, timeout=YOLO_TIMEOUT)
             response.raise_for_status()
             logger.info(f"Received response from YOLO5 service: {response.status_code}")
             return json.loads(response.text)
@@ -150,11 +374,12 @@ class Img:
             logger.exception(f"Error during YOLO5 service request: {e}")
             raise
 
+    @timed('s3_upload')
     def upload_to_s3(self, image_path, image_name=None):
         if image_name is None:
             image_name = os.path.basename(image_path)
 
-        s3_client = boto3.client('s3')
+        s3_client = get_s3_client()
         try:
             s3_client.upload_file(image_path, self.bucket_name, image_name)
             image_url = f"https://{self.bucket_name}.s3.amazonaws.com/{image_name}"
@@ -163,3 +388,13 @@ class Img:
             logger.error(f"Error uploading file to S3: {e}")
             raise
 
+    @timed('s3_upload')
+    def upload_bytes_to_s3(self, img_bytes, image_name):
+        s3_client = get_s3_client()
+        try:
+            s3_client.upload_fileobj(BytesIO(img_bytes), self.bucket_name, image_name)
+            image_url = f"https://{self.bucket_name}.s3.amazonaws.com/{image_name}"
+            return image_url
+        except ClientError as e:
+            logger.error(f"Error uploading file to S3: {e}")
+            raise
@@ -0,0 +1,160 @@
+import functools
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from loguru import logger
+
+SERVICE = 'polybot'
+# latency buckets in seconds, from a fast filter to a slow upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOG_FORMAT = ('<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | '
+              '<magenta>{extra[trace_id]}</magenta> | '
+              '<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>')
+TRACE_HEADER = 'X-Trace-Id'
+
+trace_id_var = ContextVar('trace_id', default='-')
+_registry = []
+
+
+class Histogram:
+    """
+    Prometheus-style histogram with one series per label value
+    """
+
+    def __init__(self, name, help_text, label='stage', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, label_value=''):
+        with self.lock:
+            # [per-bucket counts, sum, count]
+            series = self.series.setdefault(label_value, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_value, (counts, total, count) in self.series.items():
+                label = f'{self.label}="{label_value}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label}}} {total}')
+                lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+class Gauge:
+    """
+    Prometheus-style gauge with one series per label value, either set/incremented directly or read from `callback()`
+    """
+
+    def __init__(self, name, help_text, label='stage', callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.callback = callback
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, label_value='', amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def dec(self, label_value='', amount=1):
+        self.inc(label_value, -amount)
+
+    def set(self, value, label_value=''):
+        with self.lock:
+            self.values[label_value] = value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        if self.callback is not None:
+            lines.append(f'{self.name} {self.callback()}')
+            return lines
+        with self.lock:
+            for label_value, value in self.values.items():
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+
+stage_seconds = Histogram(f'{SERVICE}_stage_seconds', 'Time spent in each stage of a request')
+stage_in_flight = Gauge(f'{SERVICE}_stage_in_flight', 'Requests currently inside each stage')
+
+
+def render():
+    """
+    :return: every registered metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def span(stage):
+    """
+    Times a stage of the hot path into `<service>_stage_seconds` and counts it as in flight meanwhile
+    :return:
+    """
+    stage_in_flight.inc(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_in_flight.dec(stage)
+        stage_seconds.observe(elapsed, stage)
+
+
+def timed(stage):
+    """
+    Decorator version of `span`
+    :return:
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def new_trace_id(trace_id=None):
+    """
+    Sets the trace id of the current request (a new one unless given), it's added to every log line and sent on to yolo5
+    :return: the trace id
+    """
+    trace_id = trace_id or uuid.uuid4().hex[:16]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+def current_trace_id():
+    return trace_id_var.get()
+
+
+def install_log_trace():
+    """
+    Adds the current trace id to the loguru output
+    :return:
+    """
+    logger.configure(patcher=lambda record: record['extra'].setdefault('trace_id', trace_id_var.get()))
+    logger.remove()
+    logger.add(sys.stderr, format=LOG_FORMAT)
@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import tiling
+
+_lock = threading.Lock()
+_backend = None
+
+
+def _attach(name):
+    """
+    Attaches to a shared memory block owned by the parent process, without the worker taking part in its cleanup
+    :return:
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always registers the block, harmless here: the pool workers share the parent's resource tracker
+        return shared_memory.SharedMemory(name=name)
+
+
+def _run_band(op, src_name, src_shape, dst_name, dst_shape, start, stop, params):
+    """
+    Runs one row band of a filter in a worker process, reading and writing the shared buffers in place
+    :return: the band's row sums for 'row_sums', None otherwise
+    """
+    src_shm = _attach(src_name)
+    dst_shm = _attach(dst_name) if dst_name else None
+    src = dst = None
+    try:
+        src = np.ndarray(src_shape, dtype=np.float64, buffer=src_shm.buf)
+        dst = np.ndarray(dst_shape, dtype=np.float64, buffer=dst_shm.buf) if dst_shm else None
+        if op == 'blur':
+            blur_level = params['blur_level']
+            dst[start:stop] = tiling.box_blur(src[start:stop + blur_level - 1], blur_level)
+        elif op == 'contour':
+            dst[start:stop] = tiling.contour(src[start:stop])
+        elif op == 'threshold':
+            dst[start:stop] = tiling.threshold(src[start:stop], params['average'])
+        elif op == 'salt_n_pepper':
+            # the numbers a single generator hands out from the band's first row on, as in Tiler.salt_n_pepper
+            # (one 64-bit draw per number)
+            bit_generator = np.random.PCG64(params['seed'])
+            bit_generator.advance(start * src_shape[1])
+            rand = np.random.Generator(bit_generator).random((stop - start, src_shape[1]))
+            tiling.salt_n_pepper(src[start:stop], rand, params['salt_prob'], params['pepper_prob'])
+        elif op == 'row_sums':
+            return tiling.row_sums(src[start:stop])
+        else:
+            raise ValueError(f'Unknown parallel op: {op}')
+    finally:
+        del src, dst
+        src_shm.close()
+        if dst_shm:
+            dst_shm.close()
+
+
+class ParallelBackend:
+    """
+    Runs Img filters across a process pool. The image is split into bands of `band_rows` rows, the pixels are shared
+    with the workers through shared memory so they're never pickled. Images under `min_pixels` stay serial,
+    where the pool overhead outweighs the gain.
+    Bands use the same kernels as tiling.Tiler, so every filter gives the exact serial result,
+    including a seeded salt_n_pepper whatever the band size.
+    """
+
+    def __init__(self, workers=None, band_rows=256, min_pixels=1_000_000):
+        self.workers = workers or os.cpu_count()
+        self.band_rows = band_rows
+        self.min_pixels = min_pixels
+        # spawned rather than forked: the bot process runs threads
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def worth_it(self, pixels):
+        return self.workers > 1 and pixels.size >= self.min_pixels
+
+    def bands(self, height):
+        return [(start, min(start + self.band_rows, height)) for start in range(0, height, self.band_rows)]
+
+    def _run(self, op, src_shm, src_shape, dst_shm, dst_shape, bands, params_per_band):
+        futures = [
+            self.executor.submit(_run_band, op, src_shm.name, src_shape, dst_shm.name if dst_shm else None,
+                                 dst_shape, start, stop, params)
+            for (start, stop), params in zip(bands, params_per_band)
+        ]
+        return [future.result() for future in futures]
+
+    def _map(self, pixels, op, out_shape, params=None, bands=None):
+        """
+        Copies the pixels into shared memory, runs `op` over the bands into a shared output and copies the output back
+        :return:
+        """
+        src_shm = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+        dst_shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(out_shape)) * 8, 1))
+        try:
+            np.ndarray(pixels.shape, dtype=np.float64, buffer=src_shm.buf)[:] = pixels
+            bands = bands or self.bands(out_shape[0])
+            self._run(op, src_shm, pixels.shape, dst_shm, out_shape, bands, [params or {}] * len(bands))
+            return np.ndarray(out_shape, dtype=np.float64, buffer=dst_shm.buf).copy()
+        finally:
+            for shm in (src_shm, dst_shm):
+                shm.close()
+                shm.unlink()
+
+    def blur(self, pixels, blur_level):
+        height, width = pixels.shape
+        return self._map(pixels, 'blur', (height - blur_level + 1, width - blur_level + 1), {'blur_level': blur_level})
+
+    def contour(self, pixels):
+        return self._map(pixels, 'contour', (pixels.shape[0], max(pixels.shape[1] - 1, 0)))
+
+    def segment(self, pixels):
+        src_shm = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+        dst_shm = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+        try:
+            np.ndarray(pixels.shape, dtype=np.float64, buffer=src_shm.buf)[:] = pixels
+            bands = self.bands(pixels.shape[0])
+            # parallel reduction: every band returns its row sums, added up here in row order like Tiler.segment does
+            sums = self._run('row_sums', src_shm, pixels.shape, None, None, bands, [{}] * len(bands))
+            average = np.concatenate(sums).sum() // pixels.size
+            self._run('threshold', src_shm, pixels.shape, dst_shm, pixels.shape, bands, [{'average': average}] * len(bands))
+            return np.ndarray(pixels.shape, dtype=np.float64, buffer=dst_shm.buf).copy()
+        finally:
+            for shm in (src_shm, dst_shm):
+                shm.close()
+                shm.unlink()
+
+    def salt_n_pepper(self, pixels, salt_prob, pepper_prob, seed=None):
+        shm = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+        try:
+            np.ndarray(pixels.shape, dtype=np.float64, buffer=shm.buf)[:] = pixels
+            bands = self.bands(pixels.shape[0])
+            # every band jumps ahead in the same stream, an unseeded run picks its seed here
+            if seed is None:
+                seed = np.random.SeedSequence().entropy
+            params = {'seed': seed, 'salt_prob': salt_prob, 'pepper_prob': pepper_prob}
+            self._run('salt_n_pepper', shm, pixels.shape, None, None, bands, [params] * len(bands))
+            return np.ndarray(pixels.shape, dtype=np.float64, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def get_parallel_backend():
+    """
+    Process-wide backend configured by IMG_PARALLEL_WORKERS (0 or unset: off), IMG_PARALLEL_BAND_ROWS and IMG_PARALLEL_MIN_PIXELS
+    :return: ParallelBackend or None
+    """
+    global _backend
+    workers = int(os.getenv('IMG_PARALLEL_WORKERS', 0))
+    if workers < 2:
+        return None
+    with _lock:
+        if _backend is None:
+            _backend = ParallelBackend(
+                workers,
+                band_rows=int(os.getenv('IMG_PARALLEL_BAND_ROWS', 256)),
+                min_pixels=int(os.getenv('IMG_PARALLEL_MIN_PIXELS', 1_000_000))
+            )
+        return _backend
@@ -0,0 +1,120 @@
+import queue
+import threading
+import time
+import requests
+from loguru import logger
+from clients import get_http_session
+from metrics import Gauge, current_trace_id, new_trace_id
+
+
+class PredictionPoller:
+    """
+    Waits for the predictions submitted to yolo5's `/predict/async` on a single background thread,
+    so no update worker is blocked while yolo5 works.
+    A job ends when yolo5 posts its result to the callback endpoint (see `complete`), when a status poll finds it
+    finished, or after `timeout` seconds. `on_result(context, prediction)` or `on_error(context, message)`
+    is then called with the `context` the job was tracked with.
+    """
+
+    def __init__(self, on_result, on_error, interval=2.0, timeout=120, request_timeout=10):
+        self.on_result = on_result
+        self.on_error = on_error
+        self.interval = interval
+        self.timeout = timeout
+        self.request_timeout = request_timeout
+        # prediction id -> {'url', 'context', 'trace_id', 'deadline', 'next_poll'}
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # results posted by yolo5's callbacks, delivered by the poller thread
+        self.callbacks = queue.Queue()
+        Gauge('polybot_pending_predictions', 'Predictions submitted to yolo5 and not answered yet', callback=lambda: len(self.jobs))
+        self.thread = threading.Thread(target=self._loop, name='prediction-poller', daemon=True)
+        self.thread.start()
+
+    def track(self, prediction_id, yolo_service_url, context):
+        now = time.monotonic()
+        with self.lock:
+            self.jobs[prediction_id] = {
+                'url': yolo_service_url,
+                'context': context,
+                'trace_id': current_trace_id(),
+                'deadline': now + self.timeout,
+                'next_poll': now + self.interval,
+            }
+
+    def complete(self, payload):
+        """
+        Hands over a result posted by yolo5, ignored unless its prediction id is being tracked
+        :return: True if the payload belongs to a tracked job
+        """
+        with self.lock:
+            known = payload.get('prediction_id') in self.jobs
+        if known:
+            self.callbacks.put(payload)
+        return known
+
+    def _pop(self, prediction_id):
+        with self.lock:
+            return self.jobs.pop(prediction_id, None)
+
+    def _deliver(self, job, payload):
+        # the result is logged under the trace id of the update that asked for it
+        new_trace_id(job['trace_id'])
+        try:
+            if payload.get('status') == 'success':
+                self.on_result(job['context'], payload)
+            else:
+                self.on_error(job['context'], payload.get('message', 'Prediction failed'))
+        except Exception:
+            logger.exception(f"Error delivering the result of prediction {payload.get('prediction_id')}")
+
+    def _poll(self, prediction_id, job):
+        """
+        :return: the job's final payload, None while it's still running
+        """
+        session = get_http_session()
+        url = job['url']
+        try:
+            response = session.get(f'{url}/predictions/{prediction_id}/status', timeout=self.request_timeout)
+            if response.status_code == 404:
+                # unknown to yolo5 or expired, it will never finish
+                return {'status': 'error', 'prediction_id': prediction_id, 'message': 'Prediction job not found'}
+            response.raise_for_status()
+            status = response.json()
+            if status['status'] == 'failed':
+                return {'status': 'error', 'prediction_id': prediction_id, 'message': status.get('message')}
+            if status['status'] != 'done':
+                return None
+            response = session.get(f'{url}/predictions/{prediction_id}', timeout=self.request_timeout)
+            response.raise_for_status()
+            payload = response.json()
+            payload['prediction_id'] = prediction_id
+            return payload
+        except (requests.RequestException, ValueError, KeyError) as e:
+            # transient, polled again until the deadline
+            logger.warning(f'Error polling prediction {prediction_id}: {e}')
+            return None
+
+    def _loop(self):
+        while True:
+            try:
+                payload = self.callbacks.get(timeout=self.interval)
+                job = self._pop(payload['prediction_id'])
+                if job is not None:
+                    self._deliver(job, payload)
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            with self.lock:
+                due = [(prediction_id, job) for prediction_id, job in self.jobs.items() if job['next_poll'] <= now]
+            for prediction_id, job in due:
+                if now >= job['deadline']:
+                    if self._pop(prediction_id) is not None:
+                        logger.warning(f'Prediction {prediction_id} timed out')
+                        self._deliver(job, {'status': 'error', 'prediction_id': prediction_id, 'message': 'Prediction timed out'})
+                    continue
+                payload = self._poll(prediction_id, job)
+                job['next_poll'] = time.monotonic() + self.interval
+                if payload is not None and self._pop(prediction_id) is not None:
+                    self._deliver(job, payload)
@@ -0,0 +1,99 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+
+
+def result_key(file_unique_ids, command, params=()):
+    """
+    Identifies a filter result by its inputs: the photos' `file_unique_id` (stable across chats and forwards),
+    the command and its parameters
+    :return:
+    """
+    return json.dumps([list(file_unique_ids), command, list(params)], separators=(',', ':'))
+
+
+class ResultCache:
+    """
+    Maps filter results to the Telegram `file_id` of the photo the bot sent for them, so running the same filter
+    on the same photo again is answered by re-sending that photo, without downloading, filtering or uploading.
+    The `max_entries` most recently used keys are kept in memory. If `db_path` is given, entries are also written
+    to that SQLite file (at most `max_disk_entries`, least recently used dropped first), so they survive a restart.
+    """
+
+    def __init__(self, max_entries=1024, db_path=None, max_disk_entries=100_000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            try:
+                if os.path.dirname(db_path):
+                    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+                self.db = sqlite3.connect(db_path, check_same_thread=False)
+                self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, file_id TEXT NOT NULL, used REAL NOT NULL)')
+                self.db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.error(f'Error opening the result cache {db_path}, keeping it in memory only: {e}')
+                self.db = None
+
+    def get(self, key):
+        """
+        :return: file_id of the cached result, None on a miss
+        """
+        with self.lock:
+            file_id = self.entries.get(key)
+            if file_id is not None:
+                self.entries.move_to_end(key)
+                return file_id
+            if self.db is None:
+                return None
+            try:
+                row = self.db.execute('SELECT file_id FROM results WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                self.db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.error(f'Error reading the result cache: {e}')
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, key, file_id):
+        with self.lock:
+            self._remember(key, file_id)
+            if self.db is None:
+                return
+            try:
+                self.db.execute('INSERT OR REPLACE INTO results (key, file_id, used) VALUES (?, ?, ?)', (key, file_id, time.time()))
+                self.db.execute('DELETE FROM results WHERE key IN '
+                                '(SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_disk_entries,))
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.error(f'Error writing the result cache: {e}')
+
+    def discard(self, key):
+        """
+        Forgets a result, e.g. when Telegram no longer accepts its file_id
+        :return:
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            if self.db is not None:
+                try:
+                    self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f'Error writing the result cache: {e}')
+
+    def _remember(self, key, file_id):
+        self.entries[key] = file_id
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
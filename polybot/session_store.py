@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+
+
+class SessionStore:
+    """
+    Keeps the photos each chat is currently working on, so concurrent chats don't overwrite each other.
+    A session belongs to a `chat_id` and holds the photos of a single upload: one photo, or one media group
+    (identified by its `media_group_id`). A new upload in the same chat replaces the previous session.
+
+    Sessions expire after `ttl` seconds and the least recently used ones are evicted beyond `max_sessions`,
+    each session keeps at most `max_images` photos - together these cap the memory the store can take.
+    If `spill_path` is given the store is written to that JSON file on every change and reloaded on start,
+    so pending photos survive a restart.
+    """
+
+    def __init__(self, ttl=3600, max_sessions=1000, max_images=10, spill_path=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_images = max_images
+        self.spill_path = spill_path
+        self.sessions = OrderedDict()
+        self.lock = threading.RLock()
+        if spill_path:
+            self._load()
+
+    def add_image(self, chat_id, photo, media_group_id=None):
+        """
+        Adds a photo (a JSON serializable dict) to the chat's session, starting a new session unless it belongs to the current media group
+        :return: number of photos in the session
+        """
+        key = str(chat_id)
+        with self.lock:
+            self._evict_expired()
+            session = self.sessions.get(key)
+            if session is None or media_group_id is None or session['media_group_id'] != media_group_id:
+                session = {'media_group_id': media_group_id, 'images': []}
+                self.sessions[key] = session
+
+            if len(session['images']) < self.max_images:
+                session['images'].append(photo)
+            else:
+                logger.warning(f'Session of chat {chat_id} is full, ignoring photo')
+            session['updated'] = time.time()
+            self.sessions.move_to_end(key)
+
+            while len(self.sessions) > self.max_sessions:
+                evicted_key, _ = self.sessions.popitem(last=False)
+                logger.info(f'Evicted session of chat {evicted_key}')
+
+            self._spill()
+            return len(session['images'])
+
+    def get_images(self, chat_id):
+        """
+        :return: copy of the photos in the chat's session, empty if there is no live session
+        """
+        key = str(chat_id)
+        with self.lock:
+            self._evict_expired()
+            session = self.sessions.get(key)
+            if session is None:
+                return []
+            self.sessions.move_to_end(key)
+            return list(session['images'])
+
+    def paths(self):
+        """
+        :return: the disk paths of the photos in live sessions (those saved with SAVE_PHOTOS_TO_DISK)
+        """
+        with self.lock:
+            return [photo['path'] for session in self.sessions.values() for photo in session['images'] if photo.get('path')]
+
+    def clear(self, chat_id):
+        with self.lock:
+            if self.sessions.pop(str(chat_id), None) is not None:
+                self._spill()
+
+    def _evict_expired(self):
+        expiry = time.time() - self.ttl
+        expired = [key for key, session in self.sessions.items() if session['updated'] < expiry]
+        for key in expired:
+            del self.sessions[key]
+        if expired:
+            logger.info(f'Expired {len(expired)} sessions')
+
+    def _spill(self):
+        if not self.spill_path:
+            return
+        tmp_path = f'{self.spill_path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self.sessions.items()), f)
+            os.replace(tmp_path, self.spill_path)
+        except OSError as e:
+            logger.error(f'Error writing sessions to {self.spill_path}: {e}')
+
+    def _load(self):
+        if not os.path.exists(self.spill_path):
+            return
+        try:
+            with open(self.spill_path) as f:
+                self.sessions = OrderedDict(json.load(f))
+            self._evict_expired()
+            logger.info(f'Loaded {len(self.sessions)} sessions from {self.spill_path}')
+        except (OSError, ValueError) as e:
+            logger.error(f'Error loading sessions from {self.spill_path}: {e}')
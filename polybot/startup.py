@@ -0,0 +1,63 @@
+import threading
+import time
+from contextlib import contextmanager
+from loguru import logger
+from metrics import Gauge
+
+
+class Startup:
+    """
+    Startup progress of the service: how long each phase took (imports, clients, warmup...) and whether
+    it's ready to take traffic. `/healthz` tells the process is up and its startup didn't fail (`fail` is final,
+    the process needs a restart), `/ready` waits for `mark_ready`.
+    """
+
+    def __init__(self, service, started=None):
+        self.service = service
+        # perf_counter() of the first line of the entry module, so the imports are accounted for
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = {}
+        self.error = None
+        self.ready_event = threading.Event()
+        self.gauge = Gauge(f'{service}_startup_seconds', 'Seconds spent in each startup phase', label='phase')
+
+    @property
+    def ready(self):
+        return self.ready_event.is_set()
+
+    @property
+    def healthy(self):
+        return self.error is None
+
+    def record(self, phase, seconds):
+        self.phases[phase] = round(seconds, 3)
+        self.gauge.set(seconds, phase)
+        logger.info(f'Startup phase {phase} took {seconds:.3f}s')
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def mark_ready(self):
+        self.record('total', time.perf_counter() - self.started)
+        self.ready_event.set()
+        logger.info(f'{self.service} is ready')
+
+    def fail(self, error):
+        self.error = str(error)
+        logger.error(f'{self.service} failed to start: {error}')
+
+    def report(self):
+        """
+        :return: readiness and the timings of the phases completed so far
+        """
+        return {
+            'ready': self.ready,
+            'error': self.error,
+            'uptime_s': round(time.perf_counter() - self.started, 3),
+            'phases': dict(self.phases),
+        }
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import numpy as np
+
+# Row-strip kernels behind the Img filters. Every kernel only sees the rows of its strip (plus the halo it needs),
+# and computes each output pixel with the same operations in the same order wherever the strip starts,
+# so the output is identical whatever the strip size - processing the whole image is just the one-strip case.
+
+
+def box_blur(block, blur_level):
+    """
+    Box blur of a block of rows, the result has blur_level - 1 fewer rows and columns.
+    Window sums are accumulated in the same order as the original pure Python filter, so results match it exactly.
+    :return:
+    """
+    out_height = block.shape[0] - blur_level + 1
+    out_width = block.shape[1] - blur_level + 1
+    row_sums = block[:, :out_width].copy()
+    for k in range(1, blur_level):
+        row_sums += block[:, k:k + out_width]
+    box = row_sums[:out_height].copy()
+    for k in range(1, blur_level):
+        box += row_sums[k:k + out_height]
+    return np.floor_divide(box, blur_level ** 2, out=box)
+
+
+def contour(block):
+    return np.abs(np.diff(block, axis=1))
+
+
+def threshold(block, average):
+    return np.where(block < average, 0.0, 255.0)
+
+
+def row_sums(block):
+    return block.sum(axis=1)
+
+
+def salt_n_pepper(block, rand, salt_prob, pepper_prob):
+    block[rand < salt_prob] = 255
+    block[(rand >= salt_prob) & (rand < salt_prob + pepper_prob)] = 0
+
+
+class Tiler:
+    """
+    Splits the Img filters into row strips so that the temporary buffers of a filter stay within `budget` bytes.
+    With `scratch_dir` the filter outputs are memory-mapped files in that directory instead of RAM.
+    No budget means a single strip, i.e. the whole image at once.
+    """
+
+    def __init__(self, budget=None, scratch_dir=None):
+        self.budget = budget
+        self.scratch_dir = scratch_dir
+
+    @classmethod
+    def from_env(cls):
+        budget = int(os.getenv('IMG_TILE_BUDGET', 0))
+        return cls(budget or None, os.getenv('IMG_SCRATCH_DIR'))
+
+    def strip_rows(self, height, width, buffers=2, halo=0):
+        """
+        Number of output rows per strip, for a filter that keeps `buffers` float64 temporaries of a strip (plus `halo` rows)
+        :return:
+        """
+        if not self.budget:
+            return max(height, 1)
+        rows = self.budget // (buffers * 8 * max(width, 1)) - halo
+        return min(max(rows, 1), max(height, 1))
+
+    def strips(self, height, width, buffers=2, halo=0):
+        """
+        :return: (start, stop) output row ranges covering `height` rows
+        """
+        rows = self.strip_rows(height, width, buffers, halo)
+        return [(start, min(start + rows, height)) for start in range(0, height, rows)]
+
+    def allocate(self, shape):
+        if not self.scratch_dir or 0 in shape:
+            return np.empty(shape, dtype=np.float64)
+        # the file is unlinked right away, the mapping keeps it alive until the array is released
+        with tempfile.NamedTemporaryFile(dir=self.scratch_dir, prefix='img-') as f:
+            return np.memmap(f, dtype=np.float64, mode='w+', shape=shape)
+
+    def blur(self, pixels, blur_level):
+        height, width = pixels.shape
+        out = self.allocate((height - blur_level + 1, width - blur_level + 1))
+        for start, stop in self.strips(out.shape[0], width, buffers=2, halo=blur_level - 1):
+            out[start:stop] = box_blur(pixels[start:stop + blur_level - 1], blur_level)
+        return out
+
+    def contour(self, pixels):
+        # strips are full rows, so the one column of halo contour needs is always inside the strip
+        height, width = pixels.shape
+        out = self.allocate((height, max(width - 1, 0)))
+        for start, stop in self.strips(height, width, buffers=2):
+            out[start:stop] = contour(pixels[start:stop])
+        return out
+
+    def rotate(self, pixels):
+        """
+        Rotates 90 degrees clockwise, each source strip becomes a column band of the output
+        :return:
+        """
+        height, width = pixels.shape
+        out = self.allocate((width, height))
+        for start, stop in self.strips(height, width, buffers=1):
+            out[:, height - stop:height - start] = np.rot90(pixels[start:stop], k=-1)
+        return out
+
+    def salt_n_pepper(self, pixels, salt_prob, pepper_prob, seed=None):
+        # the generator hands out the same numbers whether it's asked for one block or for consecutive strips
+        rng = np.random.default_rng(seed)
+        height, width = pixels.shape
+        for start, stop in self.strips(height, width, buffers=2):
+            salt_n_pepper(pixels[start:stop], rng.random((stop - start, width)), salt_prob, pepper_prob)
+        return pixels
+
+    def segment(self, pixels):
+        height, width = pixels.shape
+        strips = self.strips(height, width, buffers=1)
+        sums = np.concatenate([row_sums(pixels[start:stop]) for start, stop in strips])
+        average = sums.sum() // pixels.size
+        out = self.allocate((height, width))
+        for start, stop in strips:
+            out[start:stop] = threshold(pixels[start:stop], average)
+        return out
+
+    def concat(self, first, second, axis):
+        """
+        Joins two images side by side (axis=1) or one above the other (axis=0), copying strip by strip
+        :return:
+        """
+        if axis == 1:
+            height = first.shape[0]
+            out = self.allocate((height, first.shape[1] + second.shape[1]))
+            for start, stop in self.strips(height, out.shape[1], buffers=1):
+                out[start:stop, :first.shape[1]] = first[start:stop]
+                out[start:stop, first.shape[1]:] = second[start:stop]
+        else:
+            width = first.shape[1]
+            out = self.allocate((first.shape[0] + second.shape[0], width))
+            for offset, src in ((0, first), (first.shape[0], second)):
+                for start, stop in self.strips(src.shape[0], width, buffers=1):
+                    out[offset + start:offset + stop] = src[start:stop]
+        return out
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+BUSY = 'busy'
+
+
+class UpdateDispatcher:
+    """
+    Hands Telegram updates to a bounded pool of background workers, so the webhook can acknowledge them right away.
+    At most `workers` updates run at once and at most `queue_size` more wait for a free worker,
+    anything beyond that is rejected so the caller can push back on Telegram.
+    Updates whose `update_id` was already accepted are dropped (Telegram re-delivers on slow acks).
+    """
+
+    def __init__(self, handler, workers=4, queue_size=32, dedup_size=1024):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='polybot-worker')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.dedup_size = dedup_size
+        self.seen_update_ids = OrderedDict()
+        self.lock = threading.Lock()
+        # accepted updates waiting for a worker, and updates being processed
+        self.queued = 0
+        self.running = 0
+
+    def submit(self, update):
+        """
+        Queues an update for background processing
+        :return: ACCEPTED, DUPLICATE or BUSY
+        """
+        update_id = update.get('update_id')
+        with self.lock:
+            if update_id is not None and update_id in self.seen_update_ids:
+                logger.info(f'Dropping duplicate update {update_id}')
+                return DUPLICATE
+            if not self.slots.acquire(blocking=False):
+                logger.warning(f'Worker queue is full, rejecting update {update_id}')
+                return BUSY
+            if update_id is not None:
+                self.seen_update_ids[update_id] = True
+                if len(self.seen_update_ids) > self.dedup_size:
+                    self.seen_update_ids.popitem(last=False)
+            self.queued += 1
+
+        self.executor.submit(self._run, update)
+        return ACCEPTED
+
+    def _run(self, update):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            self.handler(update)
+        except Exception:
+            logger.exception(f'Error while processing update {update.get("update_id")}')
+        finally:
+            with self.lock:
+                self.running -= 1
+            self.slots.release()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
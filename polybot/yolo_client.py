@@ -0,0 +1,151 @@
+import threading
+import time
+import requests
+from loguru import logger
+from metrics import Gauge
+
+outstanding_gauge = Gauge('polybot_yolo_outstanding_requests', 'Requests in flight per yolo5 replica', label='replica')
+available_gauge = Gauge('polybot_yolo_replica_available', '1 if the yolo5 replica takes requests, 0 if ejected', label='replica')
+
+
+class NoReplicaAvailable(requests.ConnectionError):
+    pass
+
+
+class Replica:
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        # consecutive failures, the circuit opens at the client's failure_threshold
+        self.failures = 0
+        self.open_until = 0
+        # result of the last health check
+        self.healthy = True
+
+
+class YoloClient:
+    """
+    Spreads the calls to yolo5 over several replicas, without a load balancer in front of them.
+    Each call goes to the available replica with the least outstanding requests (ties taken in turns), and is retried on another
+    replica if it fails (connection errors, timeouts and 5xx answers - other errors are the caller's).
+    After `failure_threshold` consecutive failures a replica is ejected (its circuit opens) for `reset_timeout`
+    seconds, then a single trial call decides whether it's back. A background thread checks each replica's
+    /ready every `health_interval` seconds and only healthy replicas get calls.
+    """
+
+    def __init__(self, urls, failure_threshold=3, reset_timeout=30, health_interval=10, health_timeout=2):
+        if not urls:
+            raise ValueError('At least one yolo5 URL is required')
+        self.replicas = [Replica(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.lock = threading.Lock()
+        # replica the next tie-break starts from (the one after the last pick), so idle replicas take turns
+        # instead of the first one getting every call
+        self.next_index = 0
+        for replica in self.replicas:
+            self._report(replica)
+        self.health_thread = threading.Thread(target=self._health_loop, name='yolo-health', daemon=True)
+        self.health_thread.start()
+
+    def _available(self, replica, now):
+        if not replica.healthy or replica.open_until > now:
+            return False
+        # half open: one trial call at a time
+        return replica.failures < self.failure_threshold or replica.outstanding == 0
+
+    def _acquire(self, exclude=()):
+        """
+        Picks the least loaded available replica and counts the call as outstanding on it
+        :return: Replica
+        """
+        now = time.monotonic()
+        with self.lock:
+            start = self.next_index
+            ordered = self.replicas[start:] + self.replicas[:start]
+            candidates = [r for r in ordered if r not in exclude and self._available(r, now)]
+            if not candidates:
+                raise NoReplicaAvailable('No yolo5 replica is available')
+            # min keeps the first of equally loaded replicas
+            replica = min(candidates, key=lambda r: r.outstanding)
+            self.next_index = (self.replicas.index(replica) + 1) % len(self.replicas)
+            replica.outstanding += 1
+        self._report(replica)
+        return replica
+
+    def _release(self, replica, failed):
+        with self.lock:
+            replica.outstanding -= 1
+            if not failed:
+                replica.failures = 0
+            else:
+                replica.failures += 1
+                if replica.failures >= self.failure_threshold:
+                    replica.open_until = time.monotonic() + self.reset_timeout
+                    logger.warning(f'Ejecting yolo5 replica {replica.url} for {self.reset_timeout}s '
+                                   f'after {replica.failures} failures')
+        self._report(replica)
+
+    @staticmethod
+    def is_replica_failure(error):
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def call(self, func):
+        """
+        Runs `func(url)` against a replica, retrying on the others while it fails because of the replica
+        :return: func's return value
+        """
+        tried = []
+        while True:
+            try:
+                replica = self._acquire(exclude=tried)
+            except NoReplicaAvailable:
+                if tried:
+                    raise last_error
+                raise
+            tried.append(replica)
+            try:
+                result = func(replica.url)
+            except Exception as e:
+                failed = self.is_replica_failure(e)
+                self._release(replica, failed)
+                if not failed:
+                    raise
+                logger.warning(f'yolo5 replica {replica.url} failed: {e}')
+                last_error = e
+                continue
+            self._release(replica, False)
+            return result
+
+    def _report(self, replica):
+        outstanding_gauge.set(replica.outstanding, replica.url)
+        available_gauge.set(int(self._available(replica, time.monotonic())), replica.url)
+
+    def _health_loop(self):
+        while True:
+            for replica in self.replicas:
+                try:
+                    healthy = requests.get(f'{replica.url}/ready', timeout=self.health_timeout).status_code == 200
+                except requests.RequestException:
+                    healthy = False
+                if healthy != replica.healthy:
+                    logger.info(f"yolo5 replica {replica.url} is {'healthy' if healthy else 'unhealthy'}")
+                replica.healthy = healthy
+                self._report(replica)
+            time.sleep(self.health_interval)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{
+                'url': replica.url,
+                'outstanding': replica.outstanding,
+                'failures': replica.failures,
+                'healthy': replica.healthy,
+                'available': self._available(replica, now),
+            } for replica in self.replicas]
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# polybot's modules import each other by name, as they do inside the polybot image
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'polybot'))
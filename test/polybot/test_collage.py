@@ -0,0 +1,97 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import collage
+from img_proc import Img
+from tiling import Tiler
+
+
+def encode(height, width, seed, fmt='JPEG'):
+    buffer = BytesIO()
+    rgb = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    Image.fromarray(rgb).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def overlaps(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def test_row_resize_scales_to_the_smallest_height():
+    canvas, cells, boxes = collage.plan([(300, 200), (600, 800), (150, 100)], 'row', max_side=None)
+    assert boxes == [(0, 0, 150, 100), (0, 100, 150, 200), (0, 300, 150, 100)]
+    assert cells == boxes
+    assert canvas == (150, 400)
+
+
+def test_column_resize_scales_to_the_smallest_width():
+    canvas, _, boxes = collage.plan([(300, 200), (100, 400)], 'column', max_side=None)
+    assert boxes == [(0, 0, 300, 200), (300, 0, 50, 200)]
+    assert canvas == (350, 200)
+
+
+def test_pad_keeps_the_sizes_and_centers_them():
+    canvas, cells, boxes = collage.plan([(300, 200), (100, 400)], 'row', fit='pad', gap=10, max_side=None)
+    assert cells == [(0, 0, 300, 200), (0, 210, 300, 400)]
+    assert boxes == [(0, 0, 300, 200), (100, 210, 100, 400)]
+    assert canvas == (300, 610)
+
+
+def test_grid_has_empty_trailing_cells():
+    sizes = [(120, 160), (160, 120), (100, 100), (200, 300), (90, 120)]
+    canvas, cells, boxes = collage.plan(sizes, 'grid', max_side=None)
+    # 3 columns, 2 rows: the last cell has no image
+    assert len(cells) == 6 and len(boxes) == 5
+    assert {cell[0] for cell in cells} == {0, cells[3][0]}
+    for cell, box in zip(cells, boxes):
+        # resized to fit the smallest height and width, inside its cell
+        assert box[2] <= 90 and box[3] <= 100
+        assert cell[0] <= box[0] and box[0] + box[2] <= cell[0] + cell[2]
+        assert cell[1] <= box[1] and box[1] + box[3] <= cell[1] + cell[3]
+    assert not any(overlaps(a, b) for i, a in enumerate(cells) for b in cells[i + 1:])
+
+
+@pytest.mark.parametrize('layout', collage.LAYOUTS)
+@pytest.mark.parametrize('fit', collage.FITS)
+@pytest.mark.parametrize('gap', [0, 7])
+def test_canvas_never_exceeds_max_side(layout, fit, gap):
+    sizes = [(3000, 4000)] * 10 + [(4000, 3000), (2999, 4001)]
+    canvas, _, boxes = collage.plan(sizes, layout, fit, gap=gap, max_side=4096)
+    assert max(canvas) <= 4096
+    assert max(canvas) > 4096 * 0.95
+
+
+def test_unknown_layout_is_rejected():
+    with pytest.raises(ValueError, match='Unknown collage layout'):
+        collage.plan([(10, 10)], 'diagonal')
+
+
+@pytest.mark.parametrize('fmt', ['JPEG', 'PNG'])
+@pytest.mark.parametrize('command, layout, second_size', [
+    ('/horizontal', 'row', (48, 80)),
+    ('/vertical', 'column', (30, 64)),
+])
+def test_equal_sizes_match_img_concat(fmt, command, layout, second_size):
+    first, second = encode(48, 64, 1, fmt), encode(*second_size, 2, fmt)
+    expected = Img('a.jpg', buffer=first)
+    expected.concat(Img('b.jpg', buffer=second), command)
+    pixels = collage.compose([BytesIO(first), BytesIO(second)], layout)
+    np.testing.assert_array_equal(pixels, expected.pixels)
+
+
+class NanTiler(Tiler):
+    def allocate(self, shape):
+        return np.full(shape, np.nan)
+
+
+@pytest.mark.parametrize('layout', collage.LAYOUTS)
+@pytest.mark.parametrize('fit', collage.FITS)
+def test_compose_writes_every_pixel(layout, fit):
+    sources = [BytesIO(encode(height, width, i)) for i, (height, width) in
+               enumerate([(40, 60), (70, 30), (50, 50), (33, 81), (64, 48)])]
+    pixels = collage.compose(sources, layout, fit, gap=3, tiler=NanTiler())
+    assert not np.isnan(pixels).any()
+    assert pixels.shape == collage.plan([(40, 60), (70, 30), (50, 50), (33, 81), (64, 48)], layout, fit, gap=3)[0]
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from img_proc import Img
+
+
+def make_img(height=48, width=64):
+    return Img('test.png', pixels=np.random.default_rng(0).integers(0, 256, (height, width)))
+
+
+def test_pipeline_runs_every_step():
+    img = make_img()
+    img.apply_pipeline(['blur:8', 'contour', 'rotate', 'salt_n_pepper:0.1:0.1:7', 'segment'])
+    assert img.pixels.shape == (64 - 8, 48 - 8 + 1)
+
+
+@pytest.mark.parametrize('steps, message', [
+    (['sharpen'], 'Unknown filter'),
+    (['blur:8:2'], 'Too many arguments'),
+    (['blur:2.5'], 'must be an integer'),
+    (['blur:0'], 'between 1 and 48'),
+    (['blur:49'], 'between 1 and 48'),
+    # contour and the first blur leave a 48x33 image (width x height), rotated to 33x48
+    (['blur:16', 'rotate', 'blur:34'], 'between 1 and 33'),
+    (['salt_n_pepper:1.5'], 'between 0 and 1'),
+    (['salt_n_pepper:0.1:x'], 'must be a number'),
+    (['salt_n_pepper:0.1:0.1:0.5'], 'must be an integer'),
+    (['salt_n_pepper:0.1:0.1:-1'], 'must not be negative'),
+])
+def test_bad_pipeline_is_rejected_before_running(steps, message):
+    img = make_img()
+    before = img.pixels.copy()
+    with pytest.raises(ValueError, match=message):
+        img.apply_pipeline(['contour', *steps])
+    np.testing.assert_array_equal(img.pixels, before)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from parallel import ParallelBackend
+from tiling import Tiler
+
+
+@pytest.fixture(scope='module')
+def backend():
+    # bands of 7 rows, and no minimum size so the small test image really goes through the pool
+    backend = ParallelBackend(workers=2, band_rows=7, min_pixels=0)
+    yield backend
+    backend.shutdown()
+
+
+@pytest.fixture
+def pixels():
+    return np.random.default_rng(1).integers(0, 256, (64, 45)).astype(np.float64)
+
+
+# rotate and concat only move pixels, Img always runs them on the Tiler
+@pytest.mark.parametrize('name, run', [
+    ('blur', lambda engine, pixels: engine.blur(pixels, 16)),
+    ('contour', lambda engine, pixels: engine.contour(pixels)),
+    ('segment', lambda engine, pixels: engine.segment(pixels)),
+    ('salt_n_pepper', lambda engine, pixels: engine.salt_n_pepper(pixels.copy(), 0.1, 0.1, seed=42)),
+])
+def test_banded_matches_untiled(backend, pixels, name, run):
+    assert backend.worth_it(pixels) and len(backend.bands(pixels.shape[0])) > 1
+    np.testing.assert_array_equal(run(backend, pixels), run(Tiler(), pixels))
+
+
+def test_unseeded_salt_n_pepper_draws_one_stream(backend):
+    # a constant image shows where the noise landed: bands drawing the same numbers would repeat their pattern
+    noisy = backend.salt_n_pepper(np.full((64, 45), 128.0), 0.2, 0.2)
+    masks = [noisy[start:start + 7] != 128 for start in range(0, 56, 7)]
+    assert any(not np.array_equal(masks[0], mask) for mask in masks[1:])
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+import session_store
+from session_store import SessionStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(session_store.time, 'time', clock)
+    return clock
+
+
+def photo(n):
+    return {'sizes': [{'file_id': f'file-{n}'}]}
+
+
+def test_session_expires_after_ttl(clock):
+    store = SessionStore(ttl=60)
+    store.add_image(1, photo(1))
+    clock.now += 59
+    assert store.get_images(1) == [photo(1)]
+    # reading doesn't extend the session, only adding photos does
+    clock.now += 2
+    assert store.get_images(1) == []
+
+
+def test_least_recently_used_session_is_evicted(clock):
+    store = SessionStore(max_sessions=2)
+    store.add_image(1, photo(1))
+    store.add_image(2, photo(2))
+    # chat 1 is used again, so chat 2 is now the least recently used
+    store.get_images(1)
+    store.add_image(3, photo(3))
+    assert store.get_images(2) == []
+    assert store.get_images(1) == [photo(1)]
+    assert store.get_images(3) == [photo(3)]
+
+
+def test_session_keeps_at_most_max_images(clock):
+    store = SessionStore(max_images=3)
+    counts = [store.add_image(1, photo(n), media_group_id='album') for n in range(5)]
+    assert counts == [1, 2, 3, 3, 3]
+    assert store.get_images(1) == [photo(0), photo(1), photo(2)]
+
+
+def test_new_upload_replaces_the_session(clock):
+    store = SessionStore()
+    store.add_image(1, photo(1), media_group_id='album-1')
+    assert store.add_image(1, photo(2), media_group_id='album-1') == 2
+    # another media group, then a single photo, each start over
+    assert store.add_image(1, photo(3), media_group_id='album-2') == 1
+    assert store.get_images(1) == [photo(3)]
+    assert store.add_image(1, photo(4)) == 1
+    assert store.add_image(1, photo(5)) == 1
+    assert store.get_images(1) == [photo(5)]
+
+
+def test_sessions_are_spilled_and_reloaded(clock, tmp_path):
+    spill_path = tmp_path / 'sessions.json'
+    store = SessionStore(ttl=60, spill_path=str(spill_path))
+    store.add_image(1, {**photo(1), 'path': 'photos/1.jpg'}, media_group_id='album')
+    store.add_image(1, photo(2), media_group_id='album')
+    clock.now += 30
+    store.add_image(2, photo(3))
+    assert len(json.loads(spill_path.read_text())) == 2
+
+    reloaded = SessionStore(ttl=60, spill_path=str(spill_path))
+    assert reloaded.get_images(1) == [{**photo(1), 'path': 'photos/1.jpg'}, photo(2)]
+    assert reloaded.paths() == ['photos/1.jpg']
+    # the reloaded session is still part of its media group
+    assert reloaded.add_image(1, photo(4), media_group_id='album') == 3
+
+    clock.now += 45
+    # both sessions were last updated 45s ago, past a 40s ttl they aren't reloaded
+    expired = SessionStore(ttl=40, spill_path=str(spill_path))
+    assert expired.get_images(1) == [] and expired.get_images(2) == []
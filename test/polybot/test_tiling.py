@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from tiling import Tiler
+
+
+@pytest.fixture
+def pixels():
+    return np.random.default_rng(0).integers(0, 256, (97, 61)).astype(np.float64)
+
+
+@pytest.fixture(params=['budget', 'scratch_dir'])
+def tiler(request, tmp_path):
+    # a budget this small gives strips of a few rows, so every filter crosses many strip boundaries
+    if request.param == 'budget':
+        return Tiler(budget=4096)
+    return Tiler(budget=4096, scratch_dir=tmp_path)
+
+
+FILTERS = {
+    'blur': lambda tiler, pixels: tiler.blur(pixels, 16),
+    'blur_1': lambda tiler, pixels: tiler.blur(pixels, 1),
+    'contour': lambda tiler, pixels: tiler.contour(pixels),
+    'rotate': lambda tiler, pixels: tiler.rotate(pixels),
+    'segment': lambda tiler, pixels: tiler.segment(pixels),
+    'concat_horizontal': lambda tiler, pixels: tiler.concat(pixels, pixels[:, :20] * 0.5, axis=1),
+    'concat_vertical': lambda tiler, pixels: tiler.concat(pixels, pixels[:30] * 0.5, axis=0),
+    'salt_n_pepper': lambda tiler, pixels: tiler.salt_n_pepper(pixels.copy(), 0.1, 0.1, seed=42),
+}
+
+
+@pytest.mark.parametrize('name', FILTERS)
+def test_tiled_matches_untiled(name, tiler, pixels):
+    assert tiler.strip_rows(*pixels.shape) < pixels.shape[0]
+    expected = FILTERS[name](Tiler(), pixels)
+    np.testing.assert_array_equal(FILTERS[name](tiler, pixels), expected)
+
+
+def test_scratch_dir_outputs_are_memory_mapped(tmp_path, pixels):
+    assert isinstance(Tiler(scratch_dir=tmp_path).contour(pixels), np.memmap)
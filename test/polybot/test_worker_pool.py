@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from worker_pool import UpdateDispatcher, ACCEPTED, DUPLICATE, BUSY
+
+
+class BlockingHandler:
+    """
+    Holds every update until `release` is set, raises for the updates marked 'fail'
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.handled = []
+
+    def __call__(self, update):
+        self.release.wait(timeout=5)
+        self.handled.append(update['update_id'])
+        if update.get('fail'):
+            raise RuntimeError('handler failed')
+
+
+@pytest.fixture
+def handler():
+    handler = BlockingHandler()
+    yield handler
+    handler.release.set()
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not met in time'
+        time.sleep(0.01)
+
+
+def submit_once_free(dispatcher, update, timeout=2.0):
+    """
+    Submits until the update isn't rejected as BUSY, the slot of a finished update is released right after it ends
+    :return: the first result other than BUSY
+    """
+    deadline = time.monotonic() + timeout
+    while (result := dispatcher.submit(update)) == BUSY:
+        assert time.monotonic() < deadline, 'no slot was released in time'
+        time.sleep(0.01)
+    return result
+
+
+def test_duplicate_update_is_dropped(handler):
+    dispatcher = UpdateDispatcher(handler, workers=1, queue_size=4)
+    assert dispatcher.submit({'update_id': 1}) == ACCEPTED
+    assert dispatcher.submit({'update_id': 1}) == DUPLICATE
+    handler.release.set()
+    dispatcher.shutdown()
+    assert handler.handled == [1]
+
+
+def test_busy_once_workers_and_queue_are_taken(handler):
+    dispatcher = UpdateDispatcher(handler, workers=2, queue_size=1)
+    assert [dispatcher.submit({'update_id': i}) for i in range(3)] == [ACCEPTED] * 3
+    wait_until(lambda: dispatcher.running == 2)
+    assert dispatcher.queued == 1
+    assert dispatcher.submit({'update_id': 3}) == BUSY
+    handler.release.set()
+    dispatcher.shutdown()
+    assert sorted(handler.handled) == [0, 1, 2]
+
+
+def test_busy_update_is_accepted_when_redelivered(handler):
+    dispatcher = UpdateDispatcher(handler, workers=1, queue_size=0)
+    assert dispatcher.submit({'update_id': 1}) == ACCEPTED
+    assert dispatcher.submit({'update_id': 2}) == BUSY
+    handler.release.set()
+    # Telegram re-delivers the rejected update, it wasn't marked as seen so it isn't a DUPLICATE
+    assert submit_once_free(dispatcher, {'update_id': 2}) == ACCEPTED
+    dispatcher.shutdown()
+    assert handler.handled == [1, 2]
+
+
+def test_slot_is_released_when_the_handler_raises(handler):
+    dispatcher = UpdateDispatcher(handler, workers=1, queue_size=0)
+    assert dispatcher.submit({'update_id': 1, 'fail': True}) == ACCEPTED
+    assert dispatcher.submit({'update_id': 2}) == BUSY
+    handler.release.set()
+    assert submit_once_free(dispatcher, {'update_id': 3}) == ACCEPTED
+    dispatcher.shutdown()
+    assert handler.handled == [1, 3]
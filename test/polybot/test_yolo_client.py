@@ -0,0 +1,125 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from yolo_client import YoloClient, NoReplicaAvailable
+
+
+class FakeYolo:
+    """
+    yolo5 stand-in answering /predict with `predict_status` and /ready with `ready_status`, counting the predictions
+    """
+
+    def __init__(self):
+        self.predict_status = 200
+        self.ready_status = 200
+        self.predictions = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.answer(fake.ready_status if self.path == '/ready' else 404)
+
+            def do_POST(self):
+                fake.predictions += 1
+                self.answer(fake.predict_status)
+
+            def answer(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def replicas():
+    fakes = [FakeYolo() for _ in range(3)]
+    yield fakes
+    for fake in fakes:
+        fake.close()
+
+
+def predict(url):
+    response = requests.post(f'{url}/predict', timeout=2)
+    response.raise_for_status()
+    return url
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not met in time'
+        time.sleep(0.01)
+
+
+def test_idle_replicas_take_turns(replicas):
+    client = YoloClient([fake.url for fake in replicas])
+    for _ in range(9):
+        client.call(predict)
+    assert [fake.predictions for fake in replicas] == [3, 3, 3]
+
+
+def test_replica_ejected_after_failure_threshold(replicas):
+    bad, *good = replicas
+    bad.predict_status = 500
+    client = YoloClient([fake.url for fake in replicas], failure_threshold=2, reset_timeout=60)
+    for _ in range(12):
+        # the failing replica's calls are retried on another one
+        assert client.call(predict) != bad.url
+    assert bad.predictions == 2
+    assert not {stat['url']: stat for stat in client.stats()}[bad.url]['available']
+
+
+def test_half_open_replica_gets_a_single_trial(replicas):
+    bad, good, _ = replicas
+    bad.predict_status = 500
+    client = YoloClient([bad.url, good.url], failure_threshold=1, reset_timeout=0.2)
+    while bad.predictions == 0:
+        client.call(predict)
+    with pytest.raises(NoReplicaAvailable):
+        client._acquire(exclude=[client.replicas[1]])
+
+    time.sleep(0.3)
+    trial = client._acquire(exclude=[client.replicas[1]])
+    assert trial.url == bad.url
+    # a second call can't join the trial
+    with pytest.raises(NoReplicaAvailable):
+        client._acquire(exclude=[client.replicas[1]])
+    client._release(trial, failed=False)
+
+    bad.predict_status = 200
+    calls = [client.call(predict) for _ in range(4)]
+    assert calls.count(bad.url) == 2
+
+
+def test_unhealthy_replica_is_skipped(replicas):
+    sick, *healthy = replicas
+    sick.ready_status = 503
+    client = YoloClient([fake.url for fake in replicas], health_interval=0.05)
+    wait_until(lambda: not client.replicas[0].healthy)
+    for _ in range(6):
+        client.call(predict)
+    assert sick.predictions == 0
+    assert [fake.predictions for fake in healthy] == [3, 3]
+
+
+def test_no_replica_left_raises_the_last_error(replicas):
+    for fake in replicas:
+        fake.predict_status = 503
+    client = YoloClient([fake.url for fake in replicas])
+    with pytest.raises(requests.HTTPError):
+        client.call(predict)
+    assert [fake.predictions for fake in replicas] == [1, 1, 1]
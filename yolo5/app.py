@@ -1,33 +1,153 @@
 import time
+IMPORT_START = time.perf_counter()
+
 from pathlib import Path
 from flask import Flask, request, jsonify
-from detect import run
+import threading
 import uuid
-import yaml
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 import os
-import boto3
 from botocore.exceptions import ClientError
+from clients import get_s3_client
+from batcher import MicroBatcher
+from backends import BATCHED_BACKENDS, backend_weights, parse_variants, variant_name
+from prediction_cache import PredictionCache, image_hash
+import prediction_jobs
+from prediction_jobs import JobStore
+from prediction_history import PredictionHistory, HistoryQueryError
+import requests
+import metrics
+from metrics import span, timed
+from startup import Startup
+from janitor import DiskJanitor
 
 logger = logger.opt(colors=True)
+startup = Startup('yolo5', started=IMPORT_START)
+startup.record('imports', time.perf_counter() - IMPORT_START)
 
 # Environment variables
 images_bucket = os.getenv('BUCKET_NAME')
+# images sent directly to /predict are copied to S3 in the background, unless disabled
+persist_to_s3 = os.getenv('PERSIST_TO_S3', 'true').lower() == 'true'
+persist_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PERSIST_WORKERS', 2)), thread_name_prefix='s3-persist')
 
+# MongoClient connects in the background, the first query waits for it
 mongo_client = MongoClient(os.environ['MONGO_URI'])
 db = mongo_client['predictions_db']
 collection = db['predictions']
 
-with open("data/coco128.yaml", "r") as stream:
-    names = yaml.safe_load(stream)['names']
+# model variants served, as 'backend:imgsz' (backends.BACKENDS), e.g. YOLO_MODELS=onnx:640,onnx-int8:416.
+# requests pick one with the backend/imgsz args, the first one answers the others
+MODEL_VARIANTS = parse_variants(
+    os.getenv('YOLO_MODELS') or f"{os.getenv('YOLO_BACKEND', 'pytorch')}:{os.getenv('YOLO_IMG_SIZE', 640)}"
+)
+DEFAULT_BACKEND, DEFAULT_IMG_SIZE = MODEL_VARIANTS[0]
+# CPU threads per forward pass, the torch/ONNX Runtime default (one per core) if not set
+YOLO_THREADS = int(os.getenv('YOLO_THREADS', 0)) or None
+
+
+class ServedModel:
+    """
+    A loaded model variant with its own micro-batcher and prediction cache, so results of variants never mix
+    """
+
+    def __init__(self, name, server, max_batch_size, max_wait_ms):
+        self.name = name
+        self.server = server
+        self.batcher = MicroBatcher(server.predict_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, name=name)
+        self.cache = None
+
+
+# variant name -> ServedModel, loaded by warm_up in the background
+models = {}
+
+# indexed queries over past predictions
+prediction_history = PredictionHistory(collection)
+
+# predictions submitted through /predict/async run here, their status is kept in Mongo for polling
+job_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ASYNC_WORKERS', 4)), thread_name_prefix='prediction-job')
+job_store = JobStore(db['prediction_jobs'], ttl=int(os.getenv('PREDICTION_JOB_TTL', 24 * 3600)))
+CALLBACK_TIMEOUT = float(os.getenv('CALLBACK_TIMEOUT', 10))
+
+metrics.Gauge('yolo5_batch_queue_depth', 'Images waiting for the next forward pass',
+              callback=lambda: sum(model.batcher.queue.qsize() for model in list(models.values())))
+# endpoints that need the model or the prediction cache, they answer 503 until warm_up is done
+WARM_ENDPOINTS = ('predict', 'predict_async', 'prediction_by_hash', 'stats')
+
+# keeps the downloaded originals and the annotated images within JANITOR_MAX_BYTES/JANITOR_MAX_FILES
+janitor = DiskJanitor.from_env(['images', 'static/data'])
+if os.getenv('JANITOR_ENABLED', 'true').lower() == 'true':
+    janitor.start()
 
 # Initialize Flask
 app = Flask(__name__)
+metrics.install_log_trace()
+
+
+def warm_up():
+    """
+    Loads and warms up the model and prepares Mongo while Flask already answers /healthz, then marks the app ready
+    :return:
+    """
+    try:
+        with startup.phase('model'):
+            # torch and the yolov5 code are imported here, they take most of the startup time
+            from model_server import ModelServer
+            for backend, imgsz in MODEL_VARIANTS:
+                name = variant_name(backend, imgsz)
+                with startup.phase(f'model[{name}]'):
+                    weights = backend_weights(os.getenv('YOLO_WEIGHTS', 'yolov5s.pt'), backend, imgsz)
+                    # loaded once, reused by every request
+                    server = ModelServer(weights=str(weights), data='data/coco128.yaml', imgsz=imgsz, threads=YOLO_THREADS)
+                # concurrent requests are grouped into one forward pass of up to YOLO_BATCH_SIZE images,
+                # waiting at most YOLO_BATCH_WAIT_MS for the batch to fill
+                models[name] = ServedModel(
+                    name,
+                    server,
+                    max_batch_size=int(os.getenv('YOLO_BATCH_SIZE', 8)) if backend in BATCHED_BACKENDS else 1,
+                    max_wait_ms=float(os.getenv('YOLO_BATCH_WAIT_MS', 10))
+                )
+        with startup.phase('mongo'):
+            wait_for_mongo()
+            prediction_history.create_indexes()
+            job_store.create_indexes()
+            for model in models.values():
+                # repeated images are answered from earlier predictions of the same model
+                model.cache = PredictionCache(
+                    collection,
+                    model.server.version,
+                    max_entries=int(os.getenv('PREDICTION_CACHE_SIZE', 1024))
+                )
+        startup.mark_ready()
+    except Exception as e:
+        logger.exception(f'Error during warmup: {e}')
+        startup.fail(e)
+
+
+def wait_for_mongo(retry_interval=5):
+    """
+    Blocks until Mongo answers, it may come up after us (e.g. while its replica set is initiated)
+    :return:
+    """
+    while True:
+        try:
+            mongo_client.admin.command('ping')
+            return
+        except PyMongoError as e:
+            logger.warning(f'Mongo is not reachable yet, retrying in {retry_interval}s: {e}')
+            time.sleep(retry_interval)
 
 
+threading.Thread(target=warm_up, name='warmup', daemon=True).start()
+
+
+@timed('s3_download')
 def download_from_s3(bucket_name, s3_key, local_path):
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
 
     try:
         local_path = Path(local_path)
@@ -40,9 +160,10 @@ def download_from_s3(bucket_name, s3_key, local_path):
         logger.error(f'<red>Error downloading from S3: {e}</red>')
         raise
 
+@timed('s3_upload')
 def upload_to_s3(local_path, s3_key):
     bucket_name = os.getenv('BUCKET_NAME')
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
 
     try:
         s3_client.upload_file(local_path, bucket_name, s3_key)
@@ -53,109 +174,439 @@ def upload_to_s3(local_path, s3_key):
         logger.error(f"Error uploading file to S3: {e}")
         raise
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    app.logger.info("Predict endpoint was hit")
-    # img_name = request.args.get('imgName')
-    if 'imgName' in request.args:
-        img_name = request.args['imgName']
-        app.logger.info(f"Received request for image: {img_name}")
+def prediction_response(summary):
+    return jsonify({
+        "status": "success",
+        "message": "Prediction Done Successfully :D",
+        "result_path": summary
+    }), 200
 
-    else:
-        return 'Error: imgName parameter is required', 400
-    logger.info(f'Received image name: {img_name}')
 
-    prediction_id = str(uuid.uuid4())
-    logger.info(f'prediction: {prediction_id}. start processing')
+def cached_prediction_response(summary):
+    summary['cached'] = True
+    return prediction_response(summary)
+
+
+@timed('s3_upload')
+def upload_bytes_to_s3(data, s3_key):
+    s3_client = get_s3_client()
 
-    original_img_path = Path(f'images/{img_name}')
     try:
-        download_from_s3(images_bucket, img_name, str(original_img_path))
+        s3_client.upload_fileobj(BytesIO(data), images_bucket, s3_key)
+        logger.info(f'<green>Successfully uploaded s3://{images_bucket}/{s3_key}</green>')
     except ClientError as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+        logger.error(f"Error uploading file to S3: {e}")
+        raise
+
 
-    logger.info(f'Prediction: {prediction_id}. Download img completed')
+def persist_in_background(upload, *args, on_done=None):
+    """
+    Runs an S3 upload off the request path, failures are only logged. `on_done()` is called once it's over
+    :return:
+    """
+    if not persist_to_s3:
+        if on_done:
+            on_done()
+        return
+    future = persist_executor.submit(upload, *args)
+
+    def log_failure(f):
+        if f.exception() is not None:
+            logger.error(f'Background S3 upload failed: {f.exception()}')
+        if on_done:
+            on_done()
+
+    future.add_done_callback(log_failure)
+
+
+def get_uploaded_image():
+    """
+    Image bytes sent in the request body, either as the multipart field `image` or as the raw body
+    :return: (bytes, file name) or (None, None) if the image should be fetched from S3
+    """
+    if 'image' in request.files:
+        image = request.files['image']
+        return image.read(), os.path.basename(image.filename or '')
+    if request.mimetype == 'application/octet-stream' or request.mimetype.startswith('image/'):
+        return request.get_data(), None
+    return None, None
+
+
+@app.before_request
+def set_trace_id():
+    # polybot sends the trace id of the Telegram update, so both services log the same id
+    metrics.new_trace_id(request.headers.get(metrics.TRACE_HEADER))
+    if request.endpoint in WARM_ENDPOINTS and not startup.ready:
+        return jsonify({"status": "error", "message": "Warming up"}), 503
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # a failed startup is final, failing the liveness probe gets the container restarted
+    if not startup.healthy:
+        return jsonify(startup.report()), 503
+    return 'Ok'
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    return jsonify(startup.report()), 200 if startup.ready else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+class PredictionError(Exception):
+    """
+    A prediction that can't be completed, `status_code` is the HTTP status reported for it
+    """
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@app.errorhandler(PredictionError)
+def prediction_error(e):
+    return jsonify({"status": "error", "message": str(e)}), e.status_code
+
+
+def select_model():
+    """
+    Model variant picked by the request's `backend` and `imgsz` args, the default variant's for those not given
+    :return: ServedModel
+    """
+    name = variant_name(request.args.get('backend', DEFAULT_BACKEND), request.args.get('imgsz', DEFAULT_IMG_SIZE, type=int))
+    if name not in models:
+        raise PredictionError(f"Model {name} is not served, available: {', '.join(models)}", 400)
+    return models[name]
+
+
+@app.route('/predictions/by-hash/<img_hash>', methods=['GET'])
+def prediction_by_hash(img_hash):
+    model = select_model()
+    with span('cache_lookup'):
+        summary = model.cache.get(img_hash)
+    if summary is None:
+        return jsonify({"status": "error", "message": "Prediction not found"}), 404
+    return cached_prediction_response(summary)
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    # the default model's stats at the top level, every model's under 'models'
+    default_model = models[variant_name(DEFAULT_BACKEND, DEFAULT_IMG_SIZE)]
+    return jsonify({
+        **default_model.batcher.stats(),
+        'models': {name: model.batcher.stats() for name, model in models.items()},
+        'janitor': janitor.stats(),
+    })
+
+
+def local_name(img_name):
+    """
+    File name of the local copies of an image (in `images/` and `static/data/`), the S3 key `img_name` may hold
+    directories (e.g. uploads/cat.jpg) and must not reach outside these directories
+    :return:
+    """
+    name = os.path.basename(img_name)
+    return name if name not in ('', '.', '..') else f'{uuid.uuid4()}.jpg'
+
+
+def fetch_image(img_name, uploaded_bytes):
+    """
+    :return: (image bytes, original image path), downloaded from S3 (the `img_name` key) unless the image came in the request
+    """
+    if uploaded_bytes is not None:
+        # decoded in memory, the S3 copy is made in the background once we know it's a new image
+        return uploaded_bytes, img_name
+
+    original_img_path = Path(f'images/{local_name(img_name)}')
+    # the janitor leaves the file alone until it's read
+    with janitor.pin(original_img_path):
+        try:
+            download_from_s3(images_bucket, img_name, str(original_img_path))
+        except ClientError as e:
+            raise PredictionError(str(e), 500)
+        return original_img_path.read_bytes(), original_img_path
+
+
+def run_prediction(prediction_id, img_name, img_bytes, original_img_path, uploaded, annotate, model):
+    """
+    Predicts an image with the `model` variant, or finds its earlier prediction of the same image,
+    and stores the new prediction summary
+    :return: the prediction summary
+    """
+    img_hash = image_hash(img_bytes)
+    with span('cache_lookup'):
+        summary = model.cache.get(img_hash)
+    if summary is not None:
+        logger.info(f'Cache hit for image {img_name}')
+        summary['cached'] = True
+        return summary
+
+    with span('decode'):
+        im0 = model.server.decode(img_bytes)
+    if im0 is None:
+        raise PredictionError(f"Could not decode image {img_name}", 400)
+
+    # only images that decode are kept in the bucket
+    if uploaded:
+        persist_in_background(upload_bytes_to_s3, img_bytes, img_name)
 
     try:
-        run(
-            weights='yolov5s.pt',
-            data='data/coco128.yaml',
-            source=str(original_img_path),
-            project='static/data',
-            name=prediction_id,
-            save_txt=True
-        )
+        # includes the wait for the batch to fill, inference itself is timed by the model server
+        with span('batch_predict'):
+            labels = model.batcher.predict(im0)
     except Exception as e:
         logger.error(f'Error during prediction: {e}')
-        return jsonify({"status": "error", "message": str(e)}), 500
+        raise PredictionError(str(e), 500)
 
     logger.info(f'Prediction: {prediction_id}. done')
 
-    predicted_img_path = Path(f'static/data/{prediction_id}/{img_name}')
-    try:
-        upload_to_s3(str(predicted_img_path), f'{prediction_id}/{img_name}')
-    except ClientError as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-    pred_summary_path = Path(f'static/data/{prediction_id}/labels/{img_name.split(".")[0]}.txt')
-    logger.info(f"Looking for prediction summary at {pred_summary_path}")
-
-    if pred_summary_path.exists():
-        with open(pred_summary_path) as f:
-            labels = f.read().splitlines()
-            if not labels:
-                logger.error(f'Prediction result is empty at {pred_summary_path}')
-                return jsonify({"status": "error", "message": "Prediction result is empty"}), 404
-
-            labels = [line.split(' ') for line in labels]
-            labels = [{
-                'class': names[int(label[0])],
-                'cx': float(label[1]),
-                'cy': float(label[2]),
-                'width': float(label[3]),
-                'height': float(label[4]),
-            } for label in labels]
-
-        logger.info(f'Prediction: {prediction_id}. prediction summary:\n\n{labels}')
-
-        prediction_summary = {
-            'prediction_id': prediction_id,
-            'original_img_path': str(original_img_path),
-            'predicted-img_path': str(predicted_img_path),
-            'labels': labels,
-            'time': time.time()
-        }
+    if not labels:
+        logger.error(f'Prediction result is empty for {img_name}')
+        raise PredictionError("Prediction result is empty", 404)
 
+    logger.info(f'Prediction: {prediction_id}. prediction summary:\n\n{labels}')
+
+    # the annotated image is only drawn and uploaded when the caller asks for it
+    predicted_img_path = None
+    if annotate:
+        predicted_img_path = f'static/data/{prediction_id}/{local_name(img_name)}'
+        # kept by the janitor until its upload is over
+        janitor.hold(predicted_img_path)
         try:
-            # Attempt to insert the document
+            with span('annotate'):
+                predicted_img_path = model.server.annotate(im0, labels, predicted_img_path)
+        except Exception:
+            janitor.release(predicted_img_path)
+            raise
+        persist_in_background(upload_to_s3, str(predicted_img_path), f'{prediction_id}/{img_name}',
+                              on_done=lambda: janitor.release(predicted_img_path))
+
+    prediction_summary = {
+        'prediction_id': prediction_id,
+        'original_img_path': str(original_img_path),
+        'predicted-img_path': str(predicted_img_path) if predicted_img_path else None,
+        'labels': labels,
+        'image_hash': img_hash,
+        'model': model.name,
+        'model_version': model.server.version,
+        'trace_id': metrics.current_trace_id(),
+        'time': time.time()
+    }
+
+    try:
+        # Attempt to insert the document
+        with span('mongo_insert'):
             insert_result = collection.insert_one(prediction_summary)
+    except Exception as e:
+        logger.error(f"Error during MongoDB operation: {str(e)}")
+        raise PredictionError(f"An error occurred: {str(e)}", 500)
 
-            # Log the result of the insertion
-            logger.info(f"Inserted ID: {insert_result.inserted_id}")
+    # Log the result of the insertion
+    logger.info(f"Inserted ID: {insert_result.inserted_id}")
 
-            # Retrieve the inserted document
-            inserted_doc = collection.find_one({'_id': insert_result.inserted_id})
+    # The response is the document we just wrote, without the '_id' field insert_one added to it
+    response_summary = {k: v for k, v in prediction_summary.items() if k != '_id'}
 
-            # Create a new dict without the '_id' field
-            response_summary = {k: v for k, v in inserted_doc.items() if k != '_id'}
+    # Add the inserted ID as a string
+    response_summary['mongo_id'] = str(insert_result.inserted_id)
 
-            # Add the inserted ID as a string
-            response_summary['mongo_id'] = str(insert_result.inserted_id)
+    logger.info(f"Response summary: {response_summary}")
+    model.cache.put(img_hash, response_summary)
+    return response_summary
 
-            logger.info(f"Response summary: {response_summary}")
 
-            return jsonify({
-                "status": "success",
-                "message": "Prediction Done Successfully :D",
-                "result_path": response_summary
-            }), 200
+def parse_predict_request():
+    """
+    Reads the image name and the image bytes (if sent in the body) of a /predict request
+    :return: (image name, uploaded bytes or None), the image name is None if neither was given
+    """
+    uploaded_bytes, uploaded_name = get_uploaded_image()
+    if 'imgName' in request.args:
+        # the S3 key, kept as is: only the local copies are named after its base name
+        img_name = request.args['imgName']
+        app.logger.info(f"Received request for image: {img_name}")
+    elif uploaded_bytes is not None:
+        img_name = uploaded_name or f'{uuid.uuid4()}.jpg'
+    else:
+        return None, None
+    logger.info(f'Received image name: {img_name}')
+    return img_name, uploaded_bytes
+
 
-        except Exception as e:
-            logger.error(f"Error during MongoDB operation: {str(e)}")
-            return jsonify({
-                "status": "error",
-                "message": f"An error occurred: {str(e)}"
-            }), 500
+@app.route('/predict', methods=['POST'])
+@timed('predict')
+def predict():
+    app.logger.info("Predict endpoint was hit")
+    img_name, uploaded_bytes = parse_predict_request()
+    if img_name is None:
+        return 'Error: imgName parameter or an image in the request body is required', 400
+
+    model = select_model()
+    # the caller may already know the image hash, a hit then skips the download altogether
+    if 'imgHash' in request.args:
+        with span('cache_lookup'):
+            summary = model.cache.get(request.args['imgHash'])
+        if summary is not None:
+            logger.info(f'Cache hit for image {img_name}')
+            return cached_prediction_response(summary)
+
+    prediction_id = str(uuid.uuid4())
+    logger.info(f'prediction: {prediction_id}. start processing')
+
+    try:
+        img_bytes, original_img_path = fetch_image(img_name, uploaded_bytes)
+        if uploaded_bytes is None:
+            logger.info(f'Prediction: {prediction_id}. Download img completed')
+        summary = run_prediction(prediction_id, img_name, img_bytes, original_img_path,
+                                 uploaded=uploaded_bytes is not None,
+                                 annotate=request.args.get('annotate', 'false').lower() == 'true',
+                                 model=model)
+    except PredictionError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
+    return prediction_response(summary)
+
+
+def notify_callback(callback_url, payload):
+    try:
+        requests.post(callback_url, json=payload, timeout=CALLBACK_TIMEOUT).raise_for_status()
+    except requests.RequestException as e:
+        # the caller can still poll the status endpoint
+        logger.warning(f"Error calling back {callback_url}: {e}")
+
+
+def run_job(prediction_id, img_name, uploaded_bytes, annotate, model, callback_url, trace_id):
+    """
+    Runs a prediction submitted through /predict/async, recording its progress in the job store
+    :return:
+    """
+    metrics.new_trace_id(trace_id)
+    try:
+        if uploaded_bytes is None:
+            job_store.update(prediction_id, prediction_jobs.DOWNLOADING)
+        img_bytes, original_img_path = fetch_image(img_name, uploaded_bytes)
+        job_store.update(prediction_id, prediction_jobs.PREDICTING)
+        summary = run_prediction(prediction_id, img_name, img_bytes, original_img_path,
+                                 uploaded=uploaded_bytes is not None, annotate=annotate, model=model)
+    except Exception as e:
+        status_code = e.status_code if isinstance(e, PredictionError) else 500
+        logger.error(f'Prediction job {prediction_id} failed: {e}')
+        job_store.update(prediction_id, prediction_jobs.FAILED, message=str(e), status_code=status_code)
+        payload = {"status": "error", "prediction_id": prediction_id, "message": str(e), "status_code": status_code}
+    else:
+        # a cached result belongs to an earlier prediction, the job points at it
+        job_store.update(prediction_id, prediction_jobs.DONE, result_id=summary['prediction_id'])
+        payload = {"status": "success", "prediction_id": prediction_id, "result_path": summary}
+
+    if callback_url:
+        notify_callback(callback_url, payload)
+
+
+@app.route('/predict/async', methods=['POST'])
+@timed('predict_submit')
+def predict_async():
+    """
+    Queues a prediction and answers right away with its id, the result is then polled from
+    /predictions/<prediction_id>/status and /predictions/<prediction_id>, or posted to the `callbackUrl` parameter
+    :return:
+    """
+    img_name, uploaded_bytes = parse_predict_request()
+    if img_name is None:
+        return 'Error: imgName parameter or an image in the request body is required', 400
+    model = select_model()
+
+    prediction_id = str(uuid.uuid4())
+    callback_url = request.args.get('callbackUrl')
+    try:
+        job_store.create(prediction_id, img_name, callback_url)
+    except Exception as e:
+        logger.error(f"Error creating prediction job: {e}")
+        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"}), 500
+
+    job_executor.submit(run_job, prediction_id, img_name, uploaded_bytes,
+                        request.args.get('annotate', 'false').lower() == 'true', model,
+                        callback_url, metrics.current_trace_id())
+    logger.info(f'prediction: {prediction_id}. queued')
+    return jsonify({
+        "status": prediction_jobs.QUEUED,
+        "prediction_id": prediction_id,
+        "status_url": f"/predictions/{prediction_id}/status",
+        "result_url": f"/predictions/{prediction_id}"
+    }), 202
+
+
+def history_time_window():
+    """
+    :return: (since, until) epoch seconds from the request args, None where not given
+    """
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    return since, until
+
+
+@app.route('/predictions', methods=['GET'])
+def prediction_history_list():
+    """
+    Newest predictions first, e.g. /predictions?class=dog&limit=10&fields=prediction_id,labels.class,time
+    The response's next_cursor is passed back as `cursor` to get the next page.
+    :return:
+    """
+    since, until = history_time_window()
+    fields = request.args.get('fields')
+    try:
+        predictions, next_cursor = prediction_history.find(
+            label_class=request.args.get('class'),
+            since=since,
+            until=until,
+            fields=fields.split(',') if fields else None,
+            limit=request.args.get('limit', 20, type=int),
+            cursor=request.args.get('cursor')
+        )
+    except HistoryQueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"predictions": predictions, "next_cursor": next_cursor}), 200
+
+
+@app.route('/predictions/class-counts', methods=['GET'])
+def prediction_class_counts():
+    """
+    Detections and predictions per class between `since` and `until`
+    :return:
+    """
+    since, until = history_time_window()
+    counts = prediction_history.class_counts(since, until, label_class=request.args.get('class'))
+    return jsonify({"since": since, "until": until, "counts": counts}), 200
+
+
+@app.route('/predictions/<prediction_id>/status', methods=['GET'])
+def prediction_status(prediction_id):
+    job = job_store.get(prediction_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Prediction job not found"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/predictions/<prediction_id>', methods=['GET'])
+def prediction_by_id(prediction_id):
+    job = job_store.get(prediction_id)
+    # a job answered from the cache has no document of its own
+    result_id = job.get('result_id', prediction_id) if job else prediction_id
+    doc = collection.find_one({'prediction_id': result_id})
+    if doc is None:
+        if job is not None and job['status'] == prediction_jobs.FAILED:
+            return jsonify({"status": "error", "message": job.get('message')}), job.get('status_code', 500)
+        return jsonify({"status": "error", "message": "Prediction not found"}), 404
+
+    summary = {k: v for k, v in doc.items() if k != '_id'}
+    summary['mongo_id'] = str(doc['_id'])
+    if result_id != prediction_id:
+        summary['cached'] = True
+    return prediction_response(summary)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+from pathlib import Path
+from loguru import logger
+
+# inference backends, all loaded by yolov5's DetectMultiBackend from the weights file format
+BACKENDS = ('pytorch', 'torchscript', 'onnx', 'onnx-int8')
+# backends whose exported model takes any batch size, the others get one image per forward pass
+BATCHED_BACKENDS = ('pytorch', 'onnx', 'onnx-int8')
+EXPORT_SUFFIXES = {
+    'torchscript': '.torchscript',
+    'onnx': '.onnx',
+    'onnx-int8': '-int8.onnx',
+}
+
+
+def parse_variants(spec):
+    """
+    Parses a list of model variants, e.g. 'onnx:640,onnx-int8:416'
+    :return: list of (backend, image size)
+    """
+    variants = []
+    for item in spec.split(','):
+        backend, _, imgsz = item.strip().partition(':')
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend {backend}, expected one of {', '.join(BACKENDS)}")
+        variants.append((backend, int(imgsz or 640)))
+    return variants
+
+
+def variant_name(backend, imgsz):
+    return f'{backend}:{imgsz}'
+
+
+def backend_weights(weights, backend, imgsz):
+    """
+    Weights file of `backend`, exported from the PyTorch `weights` for the `imgsz` inference size on first use
+    and reused afterwards (export once per image, e.g. at build time, to keep it off the startup)
+    :return:
+    """
+    weights = Path(weights)
+    if backend == 'pytorch':
+        return weights
+    target = weights.with_name(f'{weights.stem}-{imgsz}{EXPORT_SUFFIXES[backend]}')
+    if target.exists():
+        return target
+
+    if backend == 'onnx-int8':
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        source = backend_weights(weights, 'onnx', imgsz)
+        logger.info(f'Quantizing {source} to INT8')
+        quantize_dynamic(str(source), str(target), weight_type=QuantType.QUInt8)
+        return target
+
+    # yolov5's export.py, in the app directory of the yolov5 image
+    from export import run as export_model
+    include = 'torchscript' if backend == 'torchscript' else 'onnx'
+    logger.info(f'Exporting {weights} to {backend} at {imgsz}px')
+    # dynamic axes let the ONNX model take the micro-batches
+    exported = export_model(weights=weights, imgsz=(imgsz, imgsz), include=(include,), device='cpu',
+                            dynamic=include == 'onnx')
+    Path(exported[0]).rename(target)
+    return target
@@ -0,0 +1,87 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from loguru import logger
+from metrics import Histogram
+
+# number of images per forward pass
+batch_size_histogram = Histogram('yolo5_batch_size', 'Images per forward pass', label='batcher',
+                                 buckets=(1, 2, 4, 8, 16, 32))
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests and runs them through `infer_batch` together.
+    A batch is closed once it holds `max_batch_size` items or `max_wait_ms` passed since its first item arrived,
+    every caller then gets its own result (or the exception) through its future.
+    """
+
+    def __init__(self, infer_batch, max_batch_size=8, max_wait_ms=10, name='micro-batcher'):
+        self.infer_batch = infer_batch
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batch_sizes = Counter()
+        self.stats_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def predict(self, item, timeout=None):
+        """
+        Queues a single item and waits for its result
+        :return:
+        """
+        return self.submit(item).result(timeout)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            with self.stats_lock:
+                self.batch_sizes[len(batch)] += 1
+            batch_size_histogram.observe(len(batch), self.name)
+
+            items = [item for item, _ in batch]
+            try:
+                results = self.infer_batch(items)
+            except Exception as e:
+                logger.error(f'Error during batch inference: {e}')
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        """
+        :return: current queue depth and a histogram of the batch sizes run so far
+        """
+        with self.stats_lock:
+            histogram = dict(sorted(self.batch_sizes.items()))
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'batches': sum(histogram.values()),
+            'batch_size_histogram': histogram,
+        }
@@ -0,0 +1,23 @@
+import os
+import threading
+
+_lock = threading.Lock()
+_s3_client = None
+
+
+def get_s3_client():
+    """
+    Process-wide S3 client, boto3 clients are thread safe and keep their connection pool between calls
+    :return:
+    """
+    global _s3_client
+    with _lock:
+        if _s3_client is None:
+            # imported on first use, boto3 takes a while to import and isn't needed to start serving
+            import boto3
+            from botocore.config import Config
+            _s3_client = boto3.client('s3', config=Config(
+                max_pool_connections=int(os.getenv('S3_MAX_POOL_CONNECTIONS', 20)),
+                retries={'max_attempts': 3, 'mode': 'standard'}
+            ))
+        return _s3_client
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from loguru import logger
+import metrics
+
+
+class DiskJanitor:
+    """
+    Keeps the files the service leaves behind under `roots` within a budget of `max_bytes` and `max_files`,
+    deleting the least recently used first, plus any file older than `max_age` seconds (0 keeps them).
+    It runs every `interval` seconds on a background thread and removes the directories it empties.
+
+    Files in use are never deleted: the ones pinned by in-flight requests (`pin`/`hold`), and the paths returned
+    by `protected()`, e.g. the photos of the live chat sessions.
+    """
+
+    def __init__(self, roots, max_bytes=1 << 30, max_files=10_000, max_age=0, interval=60, protected=None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age = max_age
+        self.interval = interval
+        self.protected = protected or (lambda: ())
+        self.pins = Counter()
+        self.lock = threading.Lock()
+        self.usage = {'bytes': 0, 'files': 0}
+        self.reclaimed = {'bytes': 0, 'files': 0}
+        self.last_run = None
+        prefix = f'{metrics.SERVICE}_janitor'
+        metrics.Gauge(f'{prefix}_usage_bytes', 'Bytes in the directories kept by the janitor', callback=lambda: self.usage['bytes'])
+        metrics.Gauge(f'{prefix}_usage_files', 'Files in the directories kept by the janitor', callback=lambda: self.usage['files'])
+        metrics.Gauge(f'{prefix}_reclaimed_bytes', 'Bytes deleted by the janitor so far', callback=lambda: self.reclaimed['bytes'])
+        metrics.Gauge(f'{prefix}_reclaimed_files', 'Files deleted by the janitor so far', callback=lambda: self.reclaimed['files'])
+
+    def start(self):
+        threading.Thread(target=self._loop, name='disk-janitor', daemon=True).start()
+        return self
+
+    def hold(self, path):
+        """
+        Protects `path` until the matching `release`, for files used beyond a single call (e.g. background uploads)
+        :return:
+        """
+        with self.lock:
+            self.pins[os.path.abspath(path)] += 1
+
+    def release(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            self.pins[path] -= 1
+            if self.pins[path] <= 0:
+                del self.pins[path]
+
+    @contextmanager
+    def pin(self, path):
+        self.hold(path)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def _scan(self):
+        """
+        :return: list of (last use, size, path) of every file under the roots
+        """
+        files = []
+        stack = [root for root in self.roots if os.path.isdir(root)]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        # atime isn't updated on noatime mounts, a file is at least as recent as its last write
+                        files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+                except OSError:
+                    continue
+        return files
+
+    def _remove_empty_dirs(self, path):
+        directory = os.path.dirname(path)
+        while directory not in self.roots and any(directory.startswith(root + os.sep) for root in self.roots):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # not empty, or already gone
+                return
+            directory = os.path.dirname(directory)
+
+    def run_once(self):
+        """
+        Scans the roots and deletes what's over the budget
+        :return: (bytes, files) deleted
+        """
+        files = sorted(self._scan())
+        total_bytes = sum(size for _, size, _ in files)
+        total_files = len(files)
+        with self.lock:
+            pinned = set(self.pins)
+        pinned.update(os.path.abspath(path) for path in self.protected() if path)
+        expiry = time.time() - self.max_age if self.max_age else None
+
+        deleted_bytes = deleted_files = 0
+        # oldest first, stop once within budget and past the expired files
+        for used, size, path in files:
+            over_budget = total_bytes > self.max_bytes or total_files > self.max_files
+            if not over_budget and (expiry is None or used >= expiry):
+                break
+            if path in pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f'Error deleting {path}: {e}')
+                continue
+            total_bytes -= size
+            total_files -= 1
+            deleted_bytes += size
+            deleted_files += 1
+            self._remove_empty_dirs(path)
+
+        self.usage = {'bytes': total_bytes, 'files': total_files}
+        self.reclaimed = {'bytes': self.reclaimed['bytes'] + deleted_bytes, 'files': self.reclaimed['files'] + deleted_files}
+        self.last_run = time.time()
+        if deleted_files:
+            logger.info(f'Janitor deleted {deleted_files} files ({deleted_bytes} bytes), '
+                        f'{total_files} files ({total_bytes} bytes) left')
+        return deleted_bytes, deleted_files
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Error during disk cleanup')
+            time.sleep(self.interval)
+
+    def stats(self):
+        return {
+            'roots': self.roots,
+            'max_bytes': self.max_bytes,
+            'max_files': self.max_files,
+            'max_age': self.max_age,
+            'usage': dict(self.usage),
+            'reclaimed': dict(self.reclaimed),
+            'last_run': self.last_run,
+        }
+
+    @classmethod
+    def from_env(cls, roots, protected=None):
+        """
+        Janitor configured by JANITOR_MAX_BYTES, JANITOR_MAX_FILES, JANITOR_MAX_AGE (seconds) and JANITOR_INTERVAL
+        :return:
+        """
+        return cls(
+            roots,
+            max_bytes=int(os.getenv('JANITOR_MAX_BYTES', 1 << 30)),
+            max_files=int(os.getenv('JANITOR_MAX_FILES', 10_000)),
+            max_age=float(os.getenv('JANITOR_MAX_AGE', 0)),
+            interval=float(os.getenv('JANITOR_INTERVAL', 60)),
+            protected=protected
+        )
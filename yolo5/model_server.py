@@ -0,0 +1,151 @@
+import hashlib
+import threading
+from pathlib import Path
+import cv2
+import numpy as np
+import torch
+from loguru import logger
+from metrics import span
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_coords, xyxy2xywh
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device
+
+
+def weights_version(weights):
+    """
+    Identifies the model by its weights file content, so results of different weights are never mixed up
+    :return:
+    """
+    sha = hashlib.sha256()
+    with open(weights, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return f'{Path(weights).stem}-{sha.hexdigest()[:12]}'
+
+
+class ModelServer:
+    """
+    Long-lived YOLOv5 model: the weights are loaded and warmed up once, then `predict` runs in memory
+    and returns the detections as the same label dicts `detect.run(save_txt=True)` used to write.
+    Any weights format DetectMultiBackend loads can be served (.pt, .torchscript, .onnx, see backends.py),
+    `threads` caps the CPU threads of a forward pass.
+    """
+
+    def __init__(self, weights='yolov5s.pt', data='data/coco128.yaml', imgsz=640, conf_thres=0.25, iou_thres=0.45,
+                 max_det=1000, device='cpu', threads=None):
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+        self.device = select_device(device)
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = DetectMultiBackend(weights, device=self.device, data=data)
+        if threads and getattr(self.model, 'onnx', False):
+            self.limit_onnx_threads(weights, threads)
+        self.stride = self.model.stride
+        names = self.model.names
+        self.names = [names[i] for i in sorted(names)] if isinstance(names, dict) else list(names)
+        self.imgsz = check_img_size((imgsz, imgsz), s=self.stride)
+        # the same weights at another inference size give other detections
+        self.version = f'{weights_version(weights)}@{self.imgsz[0]}'
+        self.lock = threading.Lock()
+
+        # a real forward pass: DetectMultiBackend.warmup skips the CPU, so the first request would pay for
+        # the lazy allocations and (for ONNX) the graph optimizations instead
+        self.predict_batch([np.zeros((*self.imgsz, 3), np.uint8)])
+        logger.info(f'Model {self.version} loaded, inference size {self.imgsz}')
+
+    def limit_onnx_threads(self, weights, threads):
+        """
+        DetectMultiBackend creates its ONNX Runtime session with the default options (one thread per core),
+        it's replaced by a session running on `threads` threads
+        :return:
+        """
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.model.session = onnxruntime.InferenceSession(str(weights), sess_options=options,
+                                                          providers=['CPUExecutionProvider'])
+
+    @staticmethod
+    def decode(data):
+        """
+        :return: BGR image (as returned by cv2.imread) decoded from encoded image bytes, None if they can't be decoded
+        """
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+    def preprocess(self, im0):
+        """
+        Letterboxes a BGR image to the fixed inference size and converts it to a CHW RGB array.
+        The size doesn't depend on the image, so any images can be stacked into one batch.
+        :return:
+        """
+        im = letterbox(im0, self.imgsz, stride=self.stride, auto=False)[0]
+        im = im.transpose((2, 0, 1))[::-1]
+        return np.ascontiguousarray(im)
+
+    def predict(self, im0):
+        """
+        Detects objects in a BGR image (as returned by cv2.imread)
+        :return: list of {'class', 'cx', 'cy', 'width', 'height', 'confidence'}, box coordinates normalized to the image size
+        """
+        return self.predict_batch([im0])[0]
+
+    @torch.no_grad()
+    def predict_batch(self, images):
+        """
+        Runs a single forward pass over several BGR images
+        :return: list of labels per image, in the same order
+        """
+        with span('preprocess'):
+            im = torch.from_numpy(np.stack([self.preprocess(im0) for im0 in images])).to(self.device)
+            im = im.half() if self.model.fp16 else im.float()
+            im /= 255
+
+        with self.lock, span('inference'):
+            pred = self.model(im)
+        with span('postprocess'):
+            dets = non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+            return [self.to_labels(det, im.shape[2:], im0.shape) for det, im0 in zip(dets, images)]
+
+    def to_labels(self, det, input_shape, im0_shape):
+        labels = []
+        if not len(det):
+            return labels
+        det[:, :4] = scale_coords(input_shape, det[:, :4], im0_shape).round()
+        gn = torch.tensor(im0_shape)[[1, 0, 1, 0]]
+        for *xyxy, conf, cls in reversed(det):
+            cx, cy, width, height = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()
+            labels.append({
+                'class': self.names[int(cls)],
+                'cx': cx,
+                'cy': cy,
+                'width': width,
+                'height': height,
+                'confidence': float(conf),
+            })
+        return labels
+
+    def annotate(self, im0, labels, path):
+        """
+        Draws the detected boxes on a copy of the image and writes it to `path`
+        :return:
+        """
+        h, w = im0.shape[:2]
+        annotator = Annotator(im0.copy(), line_width=3, example=str(self.names))
+        for label in labels:
+            xyxy = [
+                (label['cx'] - label['width'] / 2) * w,
+                (label['cy'] - label['height'] / 2) * h,
+                (label['cx'] + label['width'] / 2) * w,
+                (label['cy'] + label['height'] / 2) * h,
+            ]
+            annotator.box_label(xyxy, f"{label['class']} {label['confidence']:.2f}",
+                                color=colors(self.names.index(label['class']), True))
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(str(path), annotator.result())
+        return path
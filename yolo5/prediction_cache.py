@@ -0,0 +1,65 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from loguru import logger
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+
+def image_hash(data):
+    """
+    :return: hex sha256 of the image bytes
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of prediction summaries, keyed by the image hash and the model version.
+    An in-memory LRU of `max_entries` summaries sits in front of the `predictions` collection,
+    which is indexed on (image_hash, model_version) for the fallback lookups.
+    """
+
+    def __init__(self, collection, model_version, max_entries=1024):
+        self.collection = collection
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        try:
+            self.collection.create_index([('image_hash', ASCENDING), ('model_version', ASCENDING)])
+        except PyMongoError as e:
+            logger.error(f'Error creating the prediction cache index: {e}')
+
+    def get(self, img_hash):
+        """
+        :return: the stored prediction summary of the image, None on a miss
+        """
+        with self.lock:
+            summary = self.entries.get(img_hash)
+            if summary is not None:
+                self.entries.move_to_end(img_hash)
+                return dict(summary)
+
+        try:
+            doc = self.collection.find_one(
+                {'image_hash': img_hash, 'model_version': self.model_version},
+                sort=[('time', DESCENDING)]
+            )
+        except PyMongoError as e:
+            logger.error(f'Error looking up cached prediction {img_hash}: {e}')
+            return None
+        if doc is None:
+            return None
+
+        summary = {k: v for k, v in doc.items() if k != '_id'}
+        summary['mongo_id'] = str(doc['_id'])
+        self.put(img_hash, summary)
+        return summary
+
+    def put(self, img_hash, summary):
+        with self.lock:
+            self.entries[img_hash] = dict(summary)
+            self.entries.move_to_end(img_hash)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
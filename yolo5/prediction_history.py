@@ -0,0 +1,121 @@
+import base64
+import binascii
+from bson import ObjectId
+from bson.errors import InvalidId
+from loguru import logger
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+# fields a history query may return, 'labels.class' returns the detected classes without their boxes
+HISTORY_FIELDS = ('prediction_id', 'original_img_path', 'predicted-img_path', 'labels', 'labels.class',
+                  'image_hash', 'model_version', 'trace_id', 'time')
+MAX_PAGE_SIZE = 500
+
+
+class HistoryQueryError(ValueError):
+    pass
+
+
+def encode_cursor(doc):
+    """
+    Opaque position after `doc` in the (time, _id) newest-first order
+    :return:
+    """
+    return base64.urlsafe_b64encode(f"{doc['time']!r}|{doc['_id']}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        time_value, doc_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return float(time_value), ObjectId(doc_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise HistoryQueryError(f'Invalid cursor {cursor}')
+
+
+class PredictionHistory:
+    """
+    Read side of the `predictions` collection: indexed, paginated queries over past predictions
+    and per-class counts computed by the database, never by loading whole documents.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def create_indexes(self):
+        # image hash lookups use the (image_hash, model_version) index of the PredictionCache
+        try:
+            self.collection.create_index([('prediction_id', ASCENDING)])
+            self.collection.create_index([('time', DESCENDING), ('_id', DESCENDING)])
+            self.collection.create_index([('labels.class', ASCENDING), ('time', DESCENDING), ('_id', DESCENDING)])
+        except PyMongoError as e:
+            logger.error(f'Error creating the prediction history indexes: {e}')
+
+    @staticmethod
+    def time_filter(since=None, until=None):
+        time_range = {}
+        if since is not None:
+            time_range['$gte'] = since
+        if until is not None:
+            time_range['$lt'] = until
+        return {'time': time_range} if time_range else {}
+
+    def find(self, label_class=None, since=None, until=None, fields=None, limit=20, cursor=None):
+        """
+        Newest predictions first, optionally only those that detected `label_class`.
+        Pages are chained with the returned cursor, which stays stable while new predictions are inserted.
+        :return: (list of predictions with only `fields`, cursor of the next page or None on the last page)
+        """
+        fields = fields or [field for field in HISTORY_FIELDS if field != 'labels.class']
+        unknown = set(fields) - set(HISTORY_FIELDS)
+        if unknown:
+            raise HistoryQueryError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise HistoryQueryError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+
+        query = self.time_filter(since, until)
+        if label_class is not None:
+            query['labels.class'] = label_class
+        if cursor is not None:
+            last_time, last_id = decode_cursor(cursor)
+            query['$or'] = [{'time': {'$lt': last_time}}, {'time': last_time, '_id': {'$lt': last_id}}]
+
+        # 'labels' and 'labels.class' collide in a projection, the whole labels win
+        projection = {field: 1 for field in fields if not (field == 'labels.class' and 'labels' in fields)}
+        projection['time'] = 1
+        docs = list(self.collection.find(query, projection)
+                    .sort([('time', DESCENDING), ('_id', DESCENDING)])
+                    .limit(limit + 1))
+
+        next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+        # 'time' is always fetched for the cursor, only returned if asked for
+        returned = {field.split('.')[0] for field in fields}
+        predictions = []
+        for doc in docs[:limit]:
+            prediction = {k: v for k, v in doc.items() if k in returned}
+            prediction['mongo_id'] = str(doc['_id'])
+            predictions.append(prediction)
+        return predictions, next_cursor
+
+    def class_counts(self, since=None, until=None, label_class=None):
+        """
+        Detections and predictions per class in a time window, aggregated by Mongo
+        :return: list of {'class', 'detections', 'predictions'}, most detected first
+        """
+        match = self.time_filter(since, until)
+        if label_class is not None:
+            match['labels.class'] = label_class
+        pipeline = [
+            {'$match': match},
+            {'$project': {'_id': 1, 'class': '$labels.class'}},
+            {'$unwind': '$class'},
+        ]
+        if label_class is not None:
+            pipeline.append({'$match': {'class': label_class}})
+        pipeline += [
+            # detections per (prediction, class) first, so predictions are counted once per class
+            {'$group': {'_id': {'prediction': '$_id', 'class': '$class'}, 'detections': {'$sum': 1}}},
+            {'$group': {'_id': '$_id.class', 'detections': {'$sum': '$detections'}, 'predictions': {'$sum': 1}}},
+            {'$project': {'_id': 0, 'class': '$_id', 'detections': 1, 'predictions': 1}},
+            {'$sort': {'detections': DESCENDING, 'class': ASCENDING}},
+        ]
+        return list(self.collection.aggregate(pipeline))
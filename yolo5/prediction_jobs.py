@@ -0,0 +1,64 @@
+import datetime
+from loguru import logger
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+PREDICTING = 'predicting'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobStore:
+    """
+    Status of the predictions submitted through `/predict/async`, one document per `prediction_id` in `collection`.
+    The documents live in Mongo rather than in memory so any yolo5 instance can answer a status poll,
+    and expire `ttl` seconds after their last update.
+    """
+
+    def __init__(self, collection, ttl=24 * 3600):
+        self.collection = collection
+        self.ttl = ttl
+
+    def create_indexes(self):
+        try:
+            self.collection.create_index([('updated_at', ASCENDING)], expireAfterSeconds=self.ttl)
+        except PyMongoError as e:
+            logger.error(f'Error creating the prediction jobs index: {e}')
+
+    def create(self, prediction_id, img_name, callback_url=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.collection.insert_one({
+            '_id': prediction_id,
+            'img_name': img_name,
+            'status': QUEUED,
+            'callback_url': callback_url,
+            'created_at': now,
+            'updated_at': now,
+        })
+
+    def update(self, prediction_id, status, **fields):
+        """
+        Moves a job to `status`, `fields` are stored alongside (e.g. the error message of a failed job)
+        :return:
+        """
+        fields.update(status=status, updated_at=datetime.datetime.now(datetime.timezone.utc))
+        try:
+            self.collection.update_one({'_id': prediction_id}, {'$set': fields})
+        except PyMongoError as e:
+            logger.error(f'Error updating prediction job {prediction_id}: {e}')
+
+    def get(self, prediction_id):
+        """
+        :return: the job document as a JSON-ready dict, None if unknown or expired
+        """
+        doc = self.collection.find_one({'_id': prediction_id})
+        if doc is None:
+            return None
+        job = {k: v for k, v in doc.items() if k not in ('_id', 'callback_url')}
+        job['prediction_id'] = doc['_id']
+        for key in ('created_at', 'updated_at'):
+            if isinstance(job.get(key), datetime.datetime):
+                job[key] = job[key].isoformat()
+        return job